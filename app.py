@@ -1,107 +1,142 @@
 from datetime import datetime, timedelta
 import logging
 import os
-from utils import build_query, verify_body
+from utils import DEFAULT_CURSOR_LIMIT, InvalidCursor, build_query, completed_filter, current_user_id, identity_cache, identity_claims, paginate_keyset
 from dotenv import load_dotenv
 import secrets
-from flask import Flask, jsonify, request
-from flask_caching import Cache
+import click
+from flask import Blueprint, Flask, Response, current_app, g, jsonify, request, stream_with_context
 from flask_compress import Compress
 from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
 from flask_cors import CORS
-from flask_migrate import Migrate
-from flask_jwt_extended import create_access_token, set_access_cookies, jwt_required, get_jwt_identity, unset_jwt_cookies, JWTManager
-from flask_apscheduler import APScheduler
-from mailing import send_email, template_create
-from models import Todo, User, db
-from werkzeug.security import generate_password_hash, check_password_hash
-from watchtower import CloudWatchLogHandler
+from flask_jwt_extended import create_access_token, set_access_cookies, jwt_required, unset_jwt_cookies, JWTManager
+from caching import bump_user_generation, cache, cached_per_user, find_etag, layered_cache
+from changes import SyncTokenExpired, compact_tombstones, record_deletions, todo_changes
+from export import EXPORT_FORMATS, export_todos, gzip_stream
+from logs import init_logging
+from metrics import Metrics
+from mailing import mailer, template_create
+from passwords import HasherBusy, password_hasher
+from ratelimit import rate_limit_key
+from replicas import read_replicas
+from schemas import BATCH_IDS_SCHEMA, BATCH_ITEMS_SCHEMA, CHECK_ACCOUNT_SCHEMA, LOGIN_SCHEMA, SIGNUP_SCHEMA, TODO_PATCH_SCHEMA, TODO_SCHEMA, validate_body
+from models import Todo, TodoStats, User, db
+from serializers import TODO_COLUMNS, json_response, serialize_rows
+from stats import adjust_todo_stats, next_revision, reconcile_todo_stats, todo_stats, todo_total
+from sqlalchemy import delete, func, insert, inspect, select, update
+from sqlalchemy.exc import IntegrityError
+from werkzeug.http import quote_etag
 
 
 load_dotenv()
-logging.basicConfig(level=logging.INFO)
-
-app = Flask(__name__)
-app.config.from_object(os.environ['APP_SETTINGS'])
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db.init_app(app)
-
-limiter = Limiter(
-    get_remote_address,
-    app=app, storage_uri="memory://",
-)
-migrate = Migrate(app, db)
-cache = Cache(app)
-cache.init_app(app)
-compress = Compress(app)
-cloudwatch_handler = CloudWatchLogHandler(
-    log_group=app.config["AWS_LOG_GROUP"], stream_name=app.config['AWS_LOG_STREAM'],)
-logger = logging.getLogger(__name__)
-logger.addHandler(cloudwatch_handler)
-scheduler = APScheduler()
-scheduler.init_app(app)
-scheduler.start()
-
-CORS(app, origins=app.config['ALLOWED_HOSTS'])
-with app.app_context():
-    db.create_all()
-
-
-jwt = JWTManager(app)
 
-
-@scheduler.task('interval', id='send_remainder_todo',
-                seconds=3600)
-def send_remainder_todo():
-    logger.info({"message": 'send_remainder_todo', "url": request.url,
-                "method": request.method, })
-    try:
-        time_threshold = datetime.utcnow() + timedelta(hours=1)
-        todos = [todo.serialize for todo in Todo.query.filter(
-            Todo.deadline < time_threshold, Todo.completed == False).all()]
-        users = User.query.filter(User.id.in_(
-            [todo['user_id'] for todo in todos]), User.has_subscribed == True).all()
-        for user in users:
-            send_email(os.environ['AWS_MAIL_SENDER'], user.email, "Rappel tache à faire", f"""
-                <h2>Bonjour {user.name},</h2><br>
-                <p>Vous avez des tâches à faire dans moins d'une heure</p>
-                <ul>
-                    {"".join([f"<li>{todo['title']}</li>" for todo in todos if todo['user_id'] == user.id])}
-                </ul>
-                        """)
-    except BaseException as e:
-        logger.error({"url": request.url, "error": str(e)})
+api = Blueprint('api', __name__, cli_group=None)
+limiter = Limiter(rate_limit_key)
+metrics = Metrics()
+compress = Compress()
+jwt = JWTManager()
+logger = logging.getLogger(__name__)
 
 
-@app.route('/')
+def create_app(config=None):
+    """
+    Builds the API for the config object (path or class, APP_SETTINGS by
+    default). Nothing is contacted here: the database schema is managed by
+    the migrations, the external clients (SES, CloudWatch) are created on
+    first use and the reminders are sent by the scheduler process
+    (scheduler.py)
+    """
+    app = Flask(__name__)
+    app.config.from_object(config or os.environ['APP_SETTINGS'])
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+
+    limiter.init_app(app)
+    if (os.environ.get('FLASK_RUN_FROM_CLI')):
+        # `flask db ...`: alembic is only imported by the command line
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    mailer.init_app(app)
+    password_hasher.init_app(app)
+    cache.init_app(app)
+    layered_cache.init_app(app)
+    read_replicas.init_app(app, db, cache)
+    metrics.init_app(app, cache, layered_cache.local)
+    compress.init_app(app)
+    init_logging(app)
+    CORS(app, origins=app.config['ALLOWED_HOSTS'], expose_headers=['ETag'])
+    jwt.init_app(app)
+    app.register_blueprint(api)
+    return app
+
+
+@api.cli.command('reconcile-stats')
+def reconcile_stats():
+    """Recount the todo counters of every user and repair drifted ones."""
+    repairs = reconcile_todo_stats()
+    for user_id, (stored, counted) in sorted(repairs.items()):
+        print(f"user {user_id}: {stored} -> {counted} (total, completed)")
+    print(f"{len(repairs)} counters repaired")
+
+
+@api.cli.command('compact-tombstones')
+@click.option('--days', type=int, default=None, help='keep the tombstones of the last DAYS days')
+def compact_tombstones_command(days):
+    """Delete the tombstones of the todos deleted before the retention."""
+    retention = timedelta(days=days) if days is not None else current_app.config['TOMBSTONE_RETENTION']
+    print(f"{compact_tombstones(datetime.utcnow() - retention)} tombstones compacted")
+
+
+def todo_for_write(id_todo):
+    """
+    The user's todo, locked until the end of the transaction so that neither
+    the If-Match check nor the counters update can race another write
+    """
+    return Todo.query.filter(Todo.id == id_todo, Todo.user_id == current_user_id()).with_for_update().first()
+
+
+# Query parameters of get_todos that todo_stats can count
+COUNTED_FILTERS = {'page', 'completed'}
+
+
+def if_match_allows(todo):
+    return not request.if_match or find_etag(request.if_match, todo.etag) is not None
+
+
+@api.route('/')
 @limiter.limit("100/hour")
 def hello():
     return 'OK', 200
 
 
-@app.route('/api/v1/login', methods=['POST'])
-@verify_body([('email', str), ('password', str),])
+@api.route('/api/v1/login', methods=['POST'])
+@validate_body(LOGIN_SCHEMA)
 def login():
     logger.info({"message": 'try_to_login', "url": request.url,
                 "method": request.method, })
     try:
-        request_body = request.get_json(silent=True)
+        request_body = g.body
         user = User.query.filter_by(email=request_body['email']).first()
-        if (user and check_password_hash(user.password, request_body['password'])):
-            access_token = create_access_token(identity=user.email)
+        if (user and password_hasher.check(user.password, request_body['password'])):
+            if (password_hasher.needs_rehash(user.password)):
+                user.password = password_hasher.hash(request_body['password'])
+                db.session.commit()
+            access_token = create_access_token(
+                identity=user.email, additional_claims=identity_claims(user))
             response = jsonify(
                 {'message': "Connexion réussie", 'requestStatus': True, })
             set_access_cookies(response, access_token)
             return response, 200
         return jsonify({'message': 'Identifiants incorrects', 'requestStatus': False, }), 401
+    except HasherBusy:
+        return jsonify({'message': 'Serveur occupé, réessayez plus tard', 'requestStatus': False}), 503, {'Retry-After': '1'}
     except BaseException as e:
         logger.error({"url": request.url, "error": str(e),
                      "payload": request_body})
         return jsonify({'message': str(e), 'requestStatus': False}), 500
 
 
-@app.route('/api/v1/logout', methods=['POST'])
+@api.route('/api/v1/logout', methods=['POST'])
 def logout():
     response = jsonify(
         {'requestStatus': True, 'message': 'Déconnexion réussie'})
@@ -109,48 +144,53 @@ def logout():
     return response, 200
 
 
-@app.route('/api/v1/users', methods=['POST'])
-@verify_body([('name', str), ('email', str), ('password', str),])
+@api.route('/api/v1/users', methods=['POST'])
+@validate_body(SIGNUP_SCHEMA)
 def signup():
     logger.info({"message": 'signup', "url": request.url,
                 "method": request.method, })
     try:
-        request_body = request.get_json(silent=True)
+        request_body = g.body
         token = secrets.token_hex(16)
-        check_if_user_exists = User.query.filter_by(
-            name=request_body['name']).first()
-        if (check_if_user_exists):
-            return jsonify({'message': 'Pseudo deja pris', 'requestStatus': False}), 400
-        check_if_user_exists = User.query.filter_by(
-            email=request_body['email']).first()
-        if (check_if_user_exists):
-            return jsonify({'message': 'Email deja pris', 'requestStatus': False}), 400
         user = User(name=request_body['name'], email=request_body['email'],
-                    password=generate_password_hash(request_body['password']), token=token, role="simple")
+                    password=password_hasher.hash(request_body['password']), token=token, role="simple",
+                    todo_stats=TodoStats())
         db.session.add(user)
-        db.session.commit()
-        if (app.config['DEBUG'] == False):
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            # Postgres reports the index name, SQLite the column
+            if (any(name in str(e.orig) for name in ('ix_user_email', 'user.email'))):
+                return jsonify({'message': 'Email deja pris', 'requestStatus': False}), 400
+            if (any(name in str(e.orig) for name in ('ix_user_name', 'user.name'))):
+                return jsonify({'message': 'Pseudo deja pris', 'requestStatus': False}), 400
+            raise
+        if (current_app.config['DEBUG'] == False):
             template_create(user)
         return jsonify({'message': 'Utilisateur créé', 'requestStatus': True}), 201
+    except HasherBusy:
+        return jsonify({'message': 'Serveur occupé, réessayez plus tard', 'requestStatus': False}), 503, {'Retry-After': '1'}
     except BaseException as e:
         logger.error({"url": request.url, "error": str(e),
                      "payload": request_body})
         return jsonify({'message': str(e), 'requestStatus': False}), 500
 
 
-@app.route('/check-account', methods=['POST'])
-@verify_body([('token', str),])
+@api.route('/check-account', methods=['POST'])
+@validate_body(CHECK_ACCOUNT_SCHEMA)
 @jwt_required()
 def check_account():
     logger.info({"message": 'check_account',
                 "url": request.url, "method": request.method, })
     try:
-        request_body = request.get_json(silent=True)
+        request_body = g.body
         user = User.query.filter_by(token=request_body['token']).first()
         if (user):
             user.token = secrets.token_hex(16)
             user.emailChecked = True
             db.session.commit()
+            identity_cache.invalidate(user.email)
             return jsonify({'message': 'User\'mail checked', 'requestStatus': True}), 200
         return jsonify({'message': 'TokenNotValid', 'requestStatus': False}), 404
     except BaseException as e:
@@ -158,125 +198,317 @@ def check_account():
         return jsonify({'message': str(e), 'requestStatus': False}), 500
 
 
-@app.route('/api/v1/todos', methods=['POST'])
+@api.route('/api/v1/todos', methods=['POST'])
 @jwt_required()
-@verify_body([('title', str), ('description', str), ('completed', bool), ('deadline', str)])
+@validate_body(TODO_SCHEMA)
 def add_todo():
-    current_user = User.query.filter_by(email=get_jwt_identity()).first()
+    user_id = current_user_id()
     logger.info({"message": 'add_todo', "url": request.url,
                 "method": request.method, })
     try:
-        request_body = request.get_json(silent=True)
-        deadline = datetime.strptime(
-            request_body['deadline'], '%m/%d/%y %H:%M:%S')
+        request_body = g.body
         todo = Todo(
             title=request_body['title'],
             description=request_body['description'],
             completed=request_body['completed'],
-            user_id=current_user.id,
-            deadline=deadline
+            user_id=user_id,
+            deadline=request_body['deadline'],
+            revision=next_revision(user_id)
         )
         db.session.add(todo)
+        adjust_todo_stats(user_id, total=1, completed=int(todo.completed))
         db.session.commit()
+        bump_user_generation(current_user_id())
         return {'requestStatus': True, "data": todo.serialize}, 201
     except BaseException as e:
         logger.error({"url": request.url, "error": str(e)})
         return {'message': str(e), 'requestStatus': False}, 500
 
 
-@app.route('/api/v1/todos', methods=['GET'])
+@api.route('/api/v1/todos', methods=['GET'])
 @jwt_required()
 @limiter.limit("200/hour")
-@cache.cached(timeout=90, query_string=True,)
+@cached_per_user()
 def get_todos():
     logger.info({"message": 'get_todos', "url": request.url,
                 "method": request.method, })
     try:
-        current_user = User.query.filter_by(email=get_jwt_identity()).first()
+        # Plain row tuples, no ORM instances: serialize_rows builds the payload
+        query_results = build_query(request.args, current_user_id()).with_entities(
+            *TODO_COLUMNS, Todo.created_at)
+        if any(key in request.args for key in ('after', 'before', 'limit')):
+            rows, next_cursor, prev_cursor = paginate_keyset(
+                query_results, request.args)
+            return json_response({"requestStatus": True, "count": len(rows), "data": serialize_rows(rows),
+                                  "next_cursor": next_cursor, "prev_cursor": prev_cursor, })
 
         page = request.args.get('page', 1, type=int)
         per_page = 1000
-        query_results = build_query(request.args, current_user.id)
-        if (query_results.count() == 0):
+        if (COUNTED_FILTERS.issuperset(request.args)):
+            # Unfiltered or only filtered on completion: the maintained counters
+            total = todo_total(current_user_id(), completed_filter(request.args))
+            rows = query_results.order_by(Todo.id).offset(
+                (max(page, 1) - 1) * per_page).limit(per_page).all() if total else []
+        else:
+            # The total rides along as a window function so a page costs one statement
+            rows = query_results.add_columns(func.count().over()).order_by(Todo.id).offset(
+                (max(page, 1) - 1) * per_page).limit(per_page).all()
+            total = rows[0][-1] if rows else (query_results.count() if page > 1 else 0)
+        if (total == 0):
             return {"requestStatus": True, "count": 0, "data": [], "total": 0, "current_page": page}, 200
-        paginated_data = [todo.serialize for todo in query_results.paginate(
-            page=page, per_page=per_page, max_per_page=1000, error_out=False).items]
-        return {"requestStatus": True, "count": len(paginated_data), "data": paginated_data, "total": query_results.count(), "current_page": page, }, 200
+        paginated_data = serialize_rows(rows)
+        return json_response({"requestStatus": True, "count": len(paginated_data), "data": paginated_data, "total": total, "current_page": page, })
+    except InvalidCursor as e:
+        return {"requestStatus": False, "message": str(e), }, 400
     except BaseException as e:
-        cache.delete_memoized(get_todos)
         logger.error({"url": request.url, "error": str(e)})
         return {"requestStatus": False, "message": "TodosNotFound", "error": str(e), }, 404
 
 
-@app.route('/api/v1/todos/<int:id_todo>', methods=['GET'])
+@api.route('/api/v1/todos/export', methods=['GET'])
+@jwt_required()
+@limiter.limit("10/hour")
+def export_all_todos():
+    logger.info({"message": 'export_all_todos', "url": request.url,
+                "method": request.method, })
+    export_format = request.args.get('format', 'ndjson', type=str)
+    if (export_format not in EXPORT_FORMATS):
+        return {"requestStatus": False, "message": "FormatNotValid"}, 400
+    chunks = export_todos(current_user_id(), export_format)
+    headers = {'Content-Disposition': f'attachment; filename=todos.{export_format}',
+               'Vary': 'Accept-Encoding'}
+    if ('gzip' in request.accept_encodings):
+        chunks = gzip_stream(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format], headers=headers)
+
+
+@api.route('/api/v1/todos/stats', methods=['GET'])
+@jwt_required()
+@limiter.limit("200/hour")
+def get_todos_stats():
+    logger.info({"message": 'get_todos_stats', "url": request.url,
+                "method": request.method, })
+    try:
+        return {"requestStatus": True, "data": todo_stats(current_user_id())}, 200
+    except BaseException as e:
+        logger.error({"url": request.url, "error": str(e)})
+        return {"requestStatus": False, "message": str(e)}, 500
+
+
+@api.route('/api/v1/todos/changes', methods=['GET'])
+@jwt_required()
+@limiter.limit("600/hour")
+@cached_per_user()
+def get_todo_changes():
+    logger.info({"message": 'get_todo_changes', "url": request.url,
+                "method": request.method, })
+    try:
+        return json_response(todo_changes(current_user_id(), request.args.get('since', None, type=str),
+                                          request.args.get('limit', DEFAULT_CURSOR_LIMIT, type=int)))
+    except InvalidCursor as e:
+        return {"requestStatus": False, "message": str(e), }, 400
+    except SyncTokenExpired as e:
+        return {"requestStatus": False, "message": str(e), }, 410
+    except BaseException as e:
+        logger.error({"url": request.url, "error": str(e)})
+        return {"requestStatus": False, "message": str(e)}, 500
+
+
+@api.route('/api/v1/todos/<int:id_todo>', methods=['GET'])
 @jwt_required()
 @limiter.limit("100/hour")
-@cache.cached(timeout=90, key_prefix='get_one_todo')
+@cached_per_user()
 def get_one_todo(id_todo):
     logger.info({"message": 'get_one_todo', "url": request.url,
                 "method": request.method, })
     try:
-        current_user = User.query.filter_by(
-            email=get_jwt_identity()).first()
         todo = Todo.query.filter(
-            Todo.id == id_todo, Todo.user_id == current_user.id).first()
+            Todo.id == id_todo, Todo.user_id == current_user_id()).first()
         if (todo):
-            logger.info({"message": 'success', "data": todo.serialize})
-            return {"requestStatus": True, "data": todo.serialize}, 200
+            logger.debug({"message": 'success', "id_todo": todo.id})
+            return {"requestStatus": True, "data": todo.serialize}, 200, {'ETag': quote_etag(todo.etag)}
         return {"requestStatus": True, "message": "TodoNotFound"}, 404
     except BaseException as e:
         logger.error({"url": request.url, "error": str(e)})
-        return {"requestStatus": False, "message": "TodoNotFound", "error": str(e)}, 404
+        return {"requestStatus": False, "message": "TodoNotFound"}, 404
 
 
-@app.route('/api/v1/todos/<int:id_todo>', methods=['PUT'])
+@api.route('/api/v1/todos/<int:id_todo>', methods=['PUT'])
 @jwt_required()
-@verify_body([('title', str), ('description', str), ('completed', bool), ('deadline', str)])
+@validate_body(TODO_SCHEMA)
 def update_one_todo(id_todo):
     logger.info({"message": 'update_one_todo',
                 "url": request.url, "method": request.method, })
     try:
-        request_body = request.get_json(silent=True)
-        current_user = User.query.filter_by(
-            email=get_jwt_identity()).first()
-        todo = Todo.query.filter(
-            Todo.id == id_todo, Todo.user_id == current_user.id).first()
+        request_body = g.body
+        # The user's counters are locked first, then the todo
+        revision = next_revision(current_user_id())
+        todo = todo_for_write(id_todo)
         if (todo):
+            if (not if_match_allows(todo)):
+                return {"requestStatus": False, "message": "TodoModified"}, 412
+            was_completed = todo.completed
+            todo.revision = revision
             todo.title = request_body['title']
             todo.description = request_body['description']
             todo.completed = request_body['completed']
-            todo.deadline = datetime.strptime(
-                request_body['deadline'], '%m/%d/%y %H:%M:%S')
+            todo.deadline = request_body['deadline']
+            if (inspect(todo).attrs.deadline.history.has_changes()):
+                todo.reminded_at = None
+            adjust_todo_stats(todo.user_id, completed=int(todo.completed) - int(was_completed))
             db.session.commit()
-            cache.delete_memoized(get_todos)
-            cache.delete_memoized(get_one_todo, id_todo)
+            bump_user_generation(current_user_id())
 
-            return {"requestStatus": True, "data": todo.serialize}, 200
+            return {"requestStatus": True, "data": todo.serialize}, 200, {'ETag': quote_etag(todo.etag)}
         return {"requestStatus": True, "message": "TodoNotFound"}, 404
     except BaseException as e:
         logger.error({"url": request.url, "error": str(e),
                      "payload": request_body})
-        return {"requestStatus": False, "message": "TodoNotFound", "error": str(e)}, 404
+        return {"requestStatus": False, "message": "TodoNotFound"}, 404
 
 
-@app.route('/api/v1/todos/<int:id_todo>', methods=['DELETE'])
+@api.route('/api/v1/todos/<int:id_todo>', methods=['DELETE'])
 @jwt_required()
 def delete_one_todo(id_todo):
     logger.info({"message": 'delete_one_todo',
                 "url": request.url, "method": request.method, })
     try:
-        current_user = User.query.filter_by(
-            email=get_jwt_identity()).first()
-        deleted_todo = Todo.query.filter(
-            Todo.id == id_todo, Todo.user_id == current_user.id).delete()
+        revision = next_revision(current_user_id())
+        if (request.if_match):
+            todo = todo_for_write(id_todo)
+            if (todo and not if_match_allows(todo)):
+                return {"requestStatus": False, "message": "TodoModified"}, 412
+        deleted_todo = db.session.execute(delete(Todo).where(
+            Todo.id == id_todo, Todo.user_id == current_user_id()).returning(Todo.completed)).first()
         if (deleted_todo):
+            record_deletions(current_user_id(), [(id_todo, revision)])
+            adjust_todo_stats(current_user_id(), total=-1, completed=-int(deleted_todo.completed))
             db.session.commit()
+            bump_user_generation(current_user_id())
             return {"requestStatus": True, "message": "TodoDeleted"}, 200
         return {"requestStatus": True, "message": "TodoNotFound"}, 404
     except BaseException as e:
         logger.error({"url": request.url, "error": str(e)})
-        return {"requestStatus": False, "message": "TodoNotFound", "error": str(e)}, 404
+        return {"requestStatus": False, "message": "TodoNotFound"}, 404
+
+
+def batch_items(key, schema=None):
+    """
+    The items of a batch body (already validated by BATCH_*_SCHEMA), each
+    validated against schema, returns (rows, error response)
+    """
+    items = g.body[key]
+    if (len(items) > current_app.config['TODOS_BATCH_MAX_ITEMS']):
+        return None, ({"requestStatus": False, "message": f"{current_app.config['TODOS_BATCH_MAX_ITEMS']} elements maximum"}, 400)
+    if (schema is None):
+        return items, None
+    rows, errors = schema.validate_many(items)
+    if (errors):
+        return None, ({"requestStatus": False, "message": "ItemsNotValid", "errors": errors}, 400)
+    return rows, None
+
+
+@api.route('/api/v1/todos:batch', methods=['POST'])
+@jwt_required()
+@validate_body(BATCH_ITEMS_SCHEMA)
+def add_todos_batch():
+    logger.info({"message": 'add_todos_batch', "url": request.url,
+                "method": request.method, })
+    rows, error = batch_items('items', TODO_SCHEMA)
+    if (error):
+        return error
+    try:
+        user_id = current_user_id()
+        revision = next_revision(user_id, len(rows))
+        todos = db.session.scalars(insert(Todo).returning(Todo, sort_by_parameter_order=True), [
+            dict(row, user_id=user_id, revision=revision + index) for index, row in enumerate(rows)]).all()
+        results = [{"status": 201, "data": todo.serialize} for todo in todos]
+        adjust_todo_stats(user_id, total=len(todos), completed=sum(todo.completed for todo in todos))
+        db.session.commit()
+        bump_user_generation(user_id)
+        return {"requestStatus": True, "count": len(results), "results": results}, 200
+    except BaseException as e:
+        db.session.rollback()
+        logger.error({"url": request.url, "error": str(e)})
+        return {'message': str(e), 'requestStatus': False}, 500
+
+
+@api.route('/api/v1/todos:batch', methods=['PATCH'])
+@jwt_required()
+@validate_body(BATCH_ITEMS_SCHEMA)
+def update_todos_batch():
+    logger.info({"message": 'update_todos_batch', "url": request.url,
+                "method": request.method, })
+    rows, error = batch_items('items', TODO_PATCH_SCHEMA)
+    if (error):
+        return error
+    try:
+        user_id = current_user_id()
+        revision = next_revision(user_id, len(rows))
+        current = db.session.execute(select(Todo.id, Todo.completed, Todo.deadline).where(
+            Todo.id.in_([row['id'] for row in rows]), Todo.user_id == user_id).with_for_update()).all()
+        was_completed = {todo.id: todo.completed for todo in current}
+        deadlines = {todo.id: todo.deadline for todo in current}
+        owned_ids = set(was_completed)
+        # Items only carry the fields they change, or resend unchanged ones.
+        # A todo gets reminded again only for a new deadline.
+        owned_rows = []
+        for row in rows:
+            if (row['id'] not in owned_ids):
+                continue
+            if ('deadline' in row and row['deadline'] != deadlines[row['id']]):
+                deadlines[row['id']] = row['deadline']
+                row = dict(row, reminded_at=None)
+            owned_rows.append(row)
+        changed_rows = [dict(row, revision=revision + index)
+                        for index, row in enumerate(owned_rows) if len(row) > 1]
+        if (changed_rows):
+            db.session.execute(update(Todo), changed_rows)
+            # The last item wins when an id is repeated
+            completed = {row['id']: row['completed'] for row in changed_rows if 'completed' in row}
+            adjust_todo_stats(user_id, completed=sum(
+                int(value) - int(was_completed[id_todo]) for id_todo, value in completed.items()))
+        db.session.commit()
+        if (owned_rows):
+            bump_user_generation(user_id)
+        results = [{"id": row['id'], "status": 200} if row['id'] in owned_ids else
+                   {"id": row['id'], "status": 404, "message": "TodoNotFound"} for row in rows]
+        return {"requestStatus": True, "count": len(owned_rows), "results": results}, 200
+    except BaseException as e:
+        db.session.rollback()
+        logger.error({"url": request.url, "error": str(e)})
+        return {'message': str(e), 'requestStatus': False}, 500
+
+
+@api.route('/api/v1/todos:batch', methods=['DELETE'])
+@jwt_required()
+@validate_body(BATCH_IDS_SCHEMA)
+def delete_todos_batch():
+    logger.info({"message": 'delete_todos_batch', "url": request.url,
+                "method": request.method, })
+    ids, error = batch_items('ids')
+    if (error):
+        return error
+    try:
+        user_id = current_user_id()
+        revision = next_revision(user_id, len(ids))
+        deleted = db.session.execute(delete(Todo).where(
+            Todo.id.in_(ids), Todo.user_id == user_id).returning(Todo.id, Todo.completed)).all()
+        deleted_ids = {row.id for row in deleted}
+        record_deletions(user_id, [(row.id, revision + index) for index, row in enumerate(deleted)])
+        adjust_todo_stats(user_id, total=-len(deleted), completed=-sum(row.completed for row in deleted))
+        db.session.commit()
+        if (deleted_ids):
+            bump_user_generation(user_id)
+        results = [{"id": id_todo, "status": 200, "message": "TodoDeleted"} if id_todo in deleted_ids else
+                   {"id": id_todo, "status": 404, "message": "TodoNotFound"} for id_todo in ids]
+        return {"requestStatus": True, "count": len(deleted_ids), "results": results}, 200
+    except BaseException as e:
+        db.session.rollback()
+        logger.error({"url": request.url, "error": str(e)})
+        return {'message': str(e), 'requestStatus': False}, 500
 
 
 if (__name__ == '__main__'):
-    app.run(host='0.0.0.0')
+    create_app().run(host='0.0.0.0')
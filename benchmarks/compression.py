@@ -0,0 +1,75 @@
+"""
+CPU spent serving a cached get_todos page per Accept-Encoding: with the
+encoded variants stored in the cache (caching.encode_variants) against
+Flask-Compress compressing the cached body again on every hit (previous
+path, the cache then holding the identity body only).
+
+    python -m benchmarks.compression --todos 1000 --repeat 200
+
+The page is read from a deterministic SQLite dataset (benchmarks.load.seed)
+through the application built with config.BenchmarkConfig.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from unittest import mock
+from benchmarks.load import BENCHMARK_ENV, PASSWORD, seed, user_email
+
+ACCEPT_ENCODINGS = ('gzip, deflate, br', 'gzip', 'identity')
+
+
+def measure(client, path, accept_encoding, repeat):
+    headers = {'Accept-Encoding': accept_encoding}
+    response = client.get(path, headers=headers)
+    assert response.status_code == 200, response.status_code
+    durations = []
+    for _ in range(repeat):
+        start = time.process_time()
+        response = client.get(path, headers=headers)
+        durations.append(time.process_time() - start)
+    return statistics.median(durations) * 1000, len(response.data), response.headers.get('Content-Encoding')
+
+
+def report(client, path, repeat, label):
+    print(f"==== {label} ====")
+    timings = {}
+    for accept_encoding in ACCEPT_ENCODINGS:
+        cpu, size, encoding = measure(client, path, accept_encoding, repeat)
+        timings[accept_encoding] = cpu
+        print(f"{accept_encoding!r:>22}: {cpu:.3f} ms CPU per hit, {size} bytes ({encoding or 'identity'})")
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--todos', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'compression.db')
+        os.environ.update(BENCHMARK_ENV, BENCHMARK_DATABASE_URI=f'sqlite:///{database}')
+        seed(database, 1, args.todos, 42)
+        import caching
+        from app import create_app
+        from caching import layered_cache
+
+        app = create_app()
+        client = app.test_client()
+        response = client.post('/api/v1/login', json={'email': user_email(1), 'password': PASSWORD})
+        assert response.status_code == 200, response.status_code
+        path = f'/api/v1/todos?sort=id&limit={args.todos}'
+        with app.app_context():
+            with mock.patch.object(caching, 'encode_variants', lambda body, mimetype: {'identity': body}):
+                before = report(client, path, args.repeat, 'before (compressed on every hit)')
+            layered_cache.clear()
+            after = report(client, path, args.repeat, 'after (cached encoded variants)')
+        for accept_encoding in ACCEPT_ENCODINGS:
+            saved = before[accept_encoding] - after[accept_encoding]
+            print(f"{accept_encoding!r:>22}: {saved:.3f} ms CPU saved per hit "
+                  f"({before[accept_encoding] / after[accept_encoding]:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+"""
+Load test of the API endpoints: throughput and p50/p95/p99 latencies under
+concurrency, compared to a stored baseline.
+
+    python -m benchmarks.load --users 50 --todos 100000 --concurrency 8 --save-baseline benchmarks/baseline.json
+    python -m benchmarks.load --users 50 --todos 100000 --concurrency 8 --baseline benchmarks/baseline.json
+
+Everything runs offline: the dataset is seeded deterministically into a
+SQLite file and the API is started locally with config.BenchmarkConfig
+(memory mail transport, file logs, no rate limits). --target points the
+scenarios at an already running server seeded by an earlier run instead.
+The exit status is 1 when a scenario regressed past --tolerance.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.cookies import SimpleCookie
+import http.client
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+BENCHMARK_ENV = {
+    'APP_SETTINGS': 'config.BenchmarkConfig', 'DEBUG': 'False', 'SECRET_KEY': 'benchmark',
+    'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'ALLOWED_HOSTS': '*', 'CACHE_TYPE': 'SimpleCache',
+    'CACHE_REDIS_HOST': 'localhost', 'CACHE_REDIS_PORT': '6379', 'CACHE_REDIS_DB': '0',
+    'CACHE_REDIS_URL': 'redis://localhost:6379/0', 'CACHE_DEFAULT_TIMEOUT': '500',
+    'AWS_REGION': 'us-east-1', 'AWS_ACCESS_KEY_ID': 'benchmark', 'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'AWS_MAIL_SENDER': 'benchmark@example.com', 'AWS_LOG_GROUP': 'benchmark', 'AWS_LOG_STREAM': 'benchmark',
+}
+PASSWORD = 'benchmark-password'
+SEARCH_WORDS = ('time', 'family', 'water', 'market', 'power')
+
+
+def user_email(index):
+    return f'bench{index}@example.com'
+
+
+def seed(path, users, todos, seed_value):
+    """
+    Recreates the SQLite database at path with `users` users
+    (bench<i>@example.com / PASSWORD) and `todos` todos drawn with gen_todos
+    from `seed_value`
+    """
+    from sqlalchemy import create_engine, insert
+    from werkzeug.security import generate_password_hash
+    import gen_todos
+    from config import BenchmarkConfig
+    from models import User, db
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    url = f'sqlite:///{path}'
+    engine = create_engine(url)
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        password = generate_password_hash(PASSWORD, BenchmarkConfig.PASSWORD_HASH_METHOD)
+        connection.execute(insert(User.__table__), [
+            {'id': i, 'name': f'bench{i}', 'email': user_email(i), 'password': password,
+             'token': f'{i:032x}', 'emailChecked': True, 'role': 'simple', 'has_subscribed': False}
+            for i in range(1, users + 1)])
+    args = gen_todos.parse_args(['--url', url, '--seed', str(seed_value), '--users', str(users),
+                                 '--todos', str(todos), '--processes', '1'])
+    generator = gen_todos.BatchGenerator(args, list(range(1, users + 1)))
+    fts_suspended = gen_todos.suspend_sqlite_fts(engine)
+    for index, start in enumerate(range(0, todos, args.batch_size)):
+        gen_todos.write_rows(engine, generator.batch(index, min(args.batch_size, todos - start)))
+    if fts_suspended:
+        gen_todos.rebuild_sqlite_fts(engine)
+    engine.dispose()
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_server(port, env, database):
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.load', '--serve', str(port),
+                               '--database', database], env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('the API server exited during startup')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/')
+            if connection.getresponse().status == 200:
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('the API server did not start')
+
+
+def serve(port):
+    from werkzeug.serving import WSGIRequestHandler
+    from app import create_app
+    app = create_app()
+    # Exit through SystemExit on terminate() so that the password hashing
+    # processes are shut down with the server
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    # Keep-alive, as behind a real server
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    app.run(host='127.0.0.1', port=port, threaded=True)
+
+
+class Client:
+    """
+    One logged-in user over one keep-alive connection
+    """
+
+    def __init__(self, target, user_index):
+        parts = urlsplit(target)
+        self.host, self.port = parts.hostname, parts.port
+        self.connection = None
+        self.cookies = {}
+        self.user_index = user_index
+        self.todo_ids = None
+        self.body = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in self.cookies.items())
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                self.body = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # The server closed the keep-alive connection, retry once
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+        for header in response.headers.get_all('Set-Cookie') or []:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        return response.status
+
+    def login(self):
+        return self.request('POST', '/api/v1/login',
+                            {'email': user_email(self.user_index), 'password': PASSWORD})
+
+    def own_todo_id(self, rng):
+        if self.todo_ids is None:
+            self.request('GET', '/api/v1/todos?limit=1000')
+            self.todo_ids = [todo['id'] for todo in json.loads(self.body)['data']] or [0]
+        return rng.choice(self.todo_ids)
+
+    @property
+    def csrf_headers(self):
+        return {'X-CSRF-TOKEN': self.cookies.get('csrf_access_token', '')}
+
+
+def scenarios(todos_per_user):
+    """
+    name -> function(client, rng) returning the HTTP status of one request
+    """
+    pages = max(1, todos_per_user // 1000)
+    return {
+        'login': lambda client, rng: client.login(),
+        'get_todos': lambda client, rng: client.request(
+            'GET', '/api/v1/todos?' + urlencode({'page': rng.randint(1, pages)})),
+        'get_todos_filtered': lambda client, rng: client.request(
+            'GET', '/api/v1/todos?' + urlencode({'completed': 'true', 'page': 1})),
+        'get_todos_search': lambda client, rng: client.request(
+            'GET', '/api/v1/todos?' + urlencode({'q': rng.choice(SEARCH_WORDS), 'limit': 50})),
+        'get_todos_cursor': lambda client, rng: client.request(
+            'GET', '/api/v1/todos?' + urlencode({'sort': 'deadline', 'limit': 100})),
+        'get_one_todo': lambda client, rng: client.request(
+            'GET', f'/api/v1/todos/{client.own_todo_id(rng)}'),
+        'add_todo': lambda client, rng: client.request(
+            'POST', '/api/v1/todos', {'title': 'benchmark', 'description': 'load test', 'completed': False,
+                                      'deadline': '01/01/30 12:00:00'}, client.csrf_headers),
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_scenario(clients, scenario, requests_count, seed_value):
+    """
+    Spreads requests_count requests of scenario over the clients, one thread
+    per client
+    """
+    latencies, errors = [], []
+    lock = threading.Lock()
+    per_client = [requests_count // len(clients) + (i < requests_count % len(clients))
+                  for i in range(len(clients))]
+
+    def drive(index):
+        rng = random.Random(seed_value * 1000 + index)
+        own_latencies, own_errors = [], 0
+        for _ in range(per_client[index]):
+            start = time.perf_counter()
+            try:
+                status = scenario(clients[index], rng)
+            except OSError:
+                status = 0
+            own_latencies.append(time.perf_counter() - start)
+            own_errors += status >= 400 or status == 0
+        with lock:
+            latencies.extend(own_latencies)
+            errors.append(own_errors)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(clients)) as pool:
+        list(pool.map(drive, range(len(clients))))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {'requests': len(latencies), 'errors': sum(errors),
+            'throughput': round(len(latencies) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Regressions of results against baseline: p95 latency up or throughput
+    down by more than tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        if result['p95_ms'] > reference['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {reference['p95_ms']} -> {result['p95_ms']} ms")
+        if result['throughput'] < reference['throughput'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {reference['throughput']} -> {result['throughput']} req/s")
+        if result['errors'] > reference['errors']:
+            regressions.append(f"{name}: errors {reference['errors']} -> {result['errors']}")
+    return regressions
+
+
+def print_results(results, baseline):
+    print(f"{'scenario':<20} {'requests':>8} {'errors':>6} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, result in results.items():
+        print(f"{name:<20} {result['requests']:>8} {result['errors']:>6} {result['throughput']:>9.1f} "
+              f"{result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f}")
+        reference = baseline.get(name)
+        if reference:
+            print(f"{'  baseline':<20} {reference['requests']:>8} {reference['errors']:>6} "
+                  f"{reference['throughput']:>9.1f} {reference['p50_ms']:>8.2f} {reference['p95_ms']:>8.2f} "
+                  f"{reference['p99_ms']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--serve', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    parser.add_argument('--target', help='base URL of a running server (default: start one)')
+    parser.add_argument('--database', default=os.path.join(os.getcwd(), 'bench_api.db'),
+                        help='SQLite file, recreated at every run')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--todos', type=int, default=50_000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=400, help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=50, help='unmeasured requests run first')
+    parser.add_argument('--scenarios', help='comma separated subset of the scenarios')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--save-baseline', help='write the results there')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    env = dict(os.environ, **BENCHMARK_ENV)
+    env['BENCHMARK_DATABASE_URI'] = f'sqlite:///{os.path.abspath(args.database)}'
+    os.environ.update(env)
+    if args.serve:
+        return serve(args.serve)
+
+    server = None
+    target = args.target
+    if target is None:
+        start = time.perf_counter()
+        seed(os.path.abspath(args.database), args.users, args.todos, args.seed)
+        print(f"dataset ready in {time.perf_counter() - start:.1f}s "
+              f"({args.users} users, {args.todos} todos, seed {args.seed})")
+        port = free_port()
+        server = start_server(port, env, os.path.abspath(args.database))
+        target = f'http://127.0.0.1:{port}'
+    try:
+        available = scenarios(args.todos // max(args.users, 1))
+        selected = args.scenarios.split(',') if args.scenarios else list(available)
+        clients = [Client(target, i % args.users + 1) for i in range(args.concurrency)]
+        for client in clients:
+            if client.login() != 200:
+                raise RuntimeError(f'login of {user_email(client.user_index)} failed, is the dataset seeded?')
+        results = {}
+        for name in selected:
+            if args.warmup:
+                run_scenario(clients, available[name], args.warmup, args.seed + 1)
+            results[name] = run_scenario(clients, available[name], args.requests, args.seed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    baseline = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    print_results(results, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump({'created_at': datetime.utcnow().isoformat(), 'users': args.users, 'todos': args.todos,
+                       'concurrency': args.concurrency, 'requests': args.requests, 'results': results},
+                      baseline_file, indent=2)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
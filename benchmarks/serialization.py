@@ -0,0 +1,73 @@
+"""
+Cost of building a 1000 todos get_todos page: ORM instances + Todo.serialize
++ jsonify (previous path) against row tuples + serialize_rows + dumps.
+
+    python -m benchmarks.serialization --todos 1000 --repeat 50
+"""
+import argparse
+from datetime import datetime, timedelta
+import random
+import statistics
+import time
+from flask import Flask
+from models import Todo, User, db
+from serializers import TODO_COLUMNS, dumps, orjson, serialize_rows
+
+
+def create_app(todos):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(id=1, name='bench', email='bench@example.com',
+                       password='x', token='0' * 32, role='simple'))
+        rng = random.Random(42)
+        db.session.execute(Todo.__table__.insert(), [
+            {'title': f'todo {i}', 'description': 'generated ' * 5, 'completed': rng.random() < 0.5,
+             'user_id': 1, 'deadline': datetime(2024, 1, 1) + timedelta(days=rng.randint(0, 120))}
+            for i in range(todos)])
+        db.session.commit()
+    return app
+
+
+def orm_path(app):
+    todos = [todo.serialize for todo in Todo.query.filter(
+        Todo.user_id == 1).order_by(Todo.id).limit(1000)]
+    return app.json.response({"requestStatus": True, "count": len(todos), "data": todos}).get_data()
+
+
+def rows_path(app):
+    rows = db.session.execute(db.select(*TODO_COLUMNS).where(
+        Todo.user_id == 1).order_by(Todo.id).limit(1000)).all()
+    todos = serialize_rows(rows)
+    return dumps({"requestStatus": True, "count": len(todos), "data": todos})
+
+
+def measure(app, path, repeat):
+    durations = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        path(app)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--todos', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    app = create_app(args.todos)
+    with app.app_context():
+        assert orm_path(app) == rows_path(app), "outputs differ"
+        before = measure(app, orm_path, args.repeat)
+        after = measure(app, rows_path, args.repeat)
+    print(f"json backend: {'orjson' if orjson else 'json'}")
+    print(f"ORM + Todo.serialize + jsonify: {before:.2f} ms per page")
+    print(f"rows + serialize_rows + dumps:  {after:.2f} ms per page ({before / after:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
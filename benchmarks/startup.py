@@ -0,0 +1,90 @@
+"""
+Startup cost of the API: how long a fresh interpreter (a gunicorn worker
+without preload, a script, a test run) takes to import app, build the
+application and serve its first request, for this tree and for an earlier
+revision exported with `git archive`.
+
+    python -m benchmarks.startup --baseline-ref HEAD~1 --repeat 10
+
+Both trees run with config.BenchmarkConfig on the same, already migrated,
+SQLite file.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from benchmarks.load import BENCHMARK_ENV
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PHASES = ('import', 'build', 'first_request')
+
+# Trees before the factory build the app while importing it
+MEASURE = """
+import json, os, time
+start = time.perf_counter()
+import app as module
+imported = time.perf_counter()
+application = module.create_app() if hasattr(module, 'create_app') else module.app
+built = time.perf_counter()
+assert application.test_client().get('/').status_code == 200
+served = time.perf_counter()
+print(json.dumps({'import': imported - start, 'build': built - imported, 'first_request': served - built}))
+# Without waiting for the threads an older tree may have started
+os._exit(0)
+"""
+
+
+def export_tree(ref, directory):
+    os.makedirs(directory)
+    archive = subprocess.run(['git', 'archive', ref], cwd=ROOT, check=True, capture_output=True).stdout
+    subprocess.run(['tar', '-x', '-C', directory], input=archive, check=True)
+    return directory
+
+
+def create_schema(path):
+    from sqlalchemy import create_engine
+    from models import db
+    engine = create_engine(f'sqlite:///{path}')
+    db.metadata.create_all(engine)
+    engine.dispose()
+
+
+def measure(tree, env, repeat):
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', MEASURE], cwd=tree, env=env, check=True,
+                                capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {phase: statistics.median(run[phase] for run in runs) * 1000 for phase in PHASES}
+
+
+def report(name, timings):
+    total = sum(timings.values())
+    print(f"{name:>10}: " + ', '.join(f"{phase} {timings[phase]:.0f} ms" for phase in PHASES)
+          + f" | total {total:.0f} ms")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--baseline-ref', default=None, help='git revision to compare with')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--config', default='config.BenchmarkConfig')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'startup.db')
+        create_schema(database)
+        env = dict(os.environ, **BENCHMARK_ENV)
+        env.update(APP_SETTINGS=args.config, BENCHMARK_DATABASE_URI=f'sqlite:///{database}')
+        current = report('current', measure(ROOT, env, args.repeat))
+        if args.baseline_ref:
+            tree = export_tree(args.baseline_ref, os.path.join(directory, 'baseline'))
+            baseline = report(args.baseline_ref, measure(tree, env, args.repeat))
+            print(f"startup {baseline / current:.2f}x faster than {args.baseline_ref}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Per-request cost of validating a todo body: the previous verify_body
+(check_body over (name, type) tuples, then strptime of the deadline in the
+view) against the compiled schemas.TODO_SCHEMA, for one todo and for a
+batch of items.
+
+    python -m benchmarks.validation --batch 500 --repeat 2000
+"""
+import argparse
+from datetime import datetime
+from functools import wraps
+import statistics
+import time
+from flask import Flask, g, request
+from schemas import TODO_SCHEMA, validate_body
+from utils import DEADLINE_FORMAT
+
+TODO_FIELDS = [('title', str), ('description', str),
+               ('completed', bool), ('deadline', str)]
+TODO = {'title': 'Buy milk', 'description': 'Two bottles of semi-skimmed milk', 'completed': False,
+        'deadline': '01/05/24 18:30:00'}
+
+
+def check_body(data, required_fields):
+    # utils.check_body before the schemas
+    if (not data):
+        return {'message': "Empty body", 'status': 'FAILED'}
+    if (len(data) != len(required_fields)):
+        return {'message': "Longueur body incorrect", 'status': 'FAILED'}
+    for required_field in required_fields:
+        body_property = data.get(required_field[0])
+        if (required_field[0] not in data):
+            return {"message": f"Champ {required_field[0]} requis", 'status': 'FAILED'}
+        if (not type(body_property) is required_field[1]):
+            return {"message": f"Champ {required_field[0]} doit être de type {required_field[1]}", 'status': 'FAILED'}
+    return None
+
+
+def verify_body(required_fields):
+    def _verify_body(f):
+        @wraps(f)
+        def __verify_body(*args, **kwargs):
+            error = check_body(request.get_json(silent=True), required_fields)
+            if (error):
+                return error
+            return f(*args, **kwargs)
+        return __verify_body
+    return _verify_body
+
+
+def legacy_item(item):
+    error = check_body(item, TODO_FIELDS)
+    return error or dict(item, deadline=datetime.strptime(item['deadline'], DEADLINE_FORMAT))
+
+
+def create_app():
+    app = Flask(__name__)
+    app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
+
+    @app.route('/legacy', methods=['POST'])
+    @verify_body(TODO_FIELDS)
+    def legacy():
+        body = request.get_json(silent=True)
+        datetime.strptime(body['deadline'], DEADLINE_FORMAT)
+        return 'OK'
+
+    @app.route('/schema', methods=['POST'])
+    @validate_body(TODO_SCHEMA)
+    def schema():
+        g.body['deadline']
+        return 'OK'
+    return app
+
+
+def measure(function, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations) * 1_000_000
+
+
+def report(name, before, after):
+    print(f"{name}: verify_body {before:,.1f} µs, schema {after:,.1f} µs ({before / after:.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+    items = [dict(TODO, title=f'Todo {i}') for i in range(args.batch)]
+    assert [legacy_item(item) for item in items] == TODO_SCHEMA.validate_many(items)[0], "outputs differ"
+
+    report("one todo", measure(lambda: legacy_item(TODO), args.repeat),
+           measure(lambda: TODO_SCHEMA.validate(TODO), args.repeat))
+    report(f"{args.batch} items batch", measure(lambda: [legacy_item(item) for item in items], args.repeat // 20 or 1),
+           measure(lambda: TODO_SCHEMA.validate_many(items), args.repeat // 20 or 1))
+
+    # Whole decorator, including reading and parsing the JSON body
+    app = create_app()
+    with app.test_request_context():
+        client = app.test_client()
+        for path in ('/legacy', '/schema'):
+            assert client.post(path, json=TODO).status_code == 200
+        report("one todo request", measure(lambda: client.post('/legacy', json=TODO), args.repeat // 4 or 1),
+               measure(lambda: client.post('/schema', json=TODO), args.repeat // 4 or 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,472 @@
+from collections import OrderedDict
+from functools import wraps
+import gzip
+import hashlib
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import brotli
+from flask import current_app, g, make_response, request
+from flask_caching import Cache
+from utils import current_user_id
+
+logger = logging.getLogger(__name__)
+cache = Cache()
+
+# Content codings stored next to the identity body of the cached reads, with
+# the Flask-Compress settings
+ENCODERS = {
+    'br': lambda body, config: brotli.compress(
+        body, mode=config['COMPRESS_BR_MODE'], quality=config['COMPRESS_BR_LEVEL'],
+        lgwin=config['COMPRESS_BR_WINDOW'], lgblock=config['COMPRESS_BR_BLOCK']),
+    'gzip': lambda body, config: gzip.compress(body, compresslevel=config['COMPRESS_LEVEL'], mtime=0),
+}
+
+
+def payload_size(value):
+    """
+    Approximate memory held by a cached value, its bytes and strings mostly
+    """
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(payload_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(payload_size(key) + payload_size(item) for key, item in value.items())
+    return sys.getsizeof(value)
+
+
+class LocalCache:
+    """
+    In-process tier of the layered cache: a LRU bounded to `max_entries`
+    entries and about `max_bytes` of payload, each entry expiring after its
+    own timeout
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, timeout):
+        size = payload_size(value)
+        with self._lock:
+            self._pop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, time.monotonic() + timeout, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+
+class LocalBus:
+    """
+    In-process stand-in for the invalidation bus: a key published reaches
+    the layered caches subscribed to this very bus (tests, single process
+    deployments without Redis)
+    """
+
+    def __init__(self):
+        self._handlers = []
+
+    def subscribe(self, handler):
+        self._handlers.append(handler)
+
+    def listen(self):
+        pass
+
+    def publish(self, key):
+        for handler in self._handlers:
+            handler(key)
+
+
+class RedisBus:
+    """
+    Invalidation bus over a Redis pub/sub channel. Every process listens from
+    a daemon thread started on its first read, i.e. after the gunicorn fork.
+    A (re)subscription is delivered as None: the local tier is cleared since
+    invalidations may have been missed meanwhile.
+    """
+
+    def __init__(self, url, channel='cache_invalidation'):
+        self.url = url
+        self.channel = channel
+        self._handlers = []
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, handler):
+        self._handlers.append(handler)
+
+    def _redis(self):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def listen(self):
+        if (self._pid == os.getpid()):
+            return
+        with self._lock:
+            if (self._pid != os.getpid()):
+                self._pid = os.getpid()
+                threading.Thread(target=self._listen, name='cache-invalidation', daemon=True).start()
+
+    def publish(self, key):
+        self._redis().publish(self.channel, key)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis().pubsub()
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    key = message['data'].decode('utf-8') if message['type'] == 'message' else None
+                    for handler in self._handlers:
+                        handler(key)
+            except Exception as e:
+                logger.warning({"message": 'cache_invalidation', "error": str(e)})
+                time.sleep(1)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+
+
+class LayeredCache:
+    """
+    Two tier cache: a bounded in-process LRU (LocalCache) in front of the
+    shared `remote` flask-caching cache (Redis).
+    - Keys changing in place (get_shared) are kept locally until an
+      invalidation published on the bus reaches every process.
+    - Computed entries (fetch) are single flight: one computation per missing
+      key, across the threads of a process and across processes with a lock
+      in the remote cache.
+    - They stay stale CACHE_STALE_TIMEOUT past their jittered freshness,
+      served to every other request while one of them recomputes the entry.
+    """
+
+    def __init__(self, remote, app=None):
+        self.remote = remote
+        self.local = LocalCache()
+        self.bus = LocalBus()
+        self.local_timeout = 60
+        self.stale_timeout = 300
+        self.jitter = 0.1
+        self.lock_timeout = 5
+        self._flights = {}
+        self._invalidations = 0
+        self._lock = threading.Lock()
+        self.bus.subscribe(self._invalidated)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, bus=None):
+        config = app.config
+        self.local = LocalCache(config.get('CACHE_LOCAL_MAX_ENTRIES', 1024),
+                                config.get('CACHE_LOCAL_MAX_BYTES', 64 * 1024 * 1024))
+        self.local_timeout = config.get('CACHE_LOCAL_TIMEOUT', 60)
+        self.stale_timeout = config.get('CACHE_STALE_TIMEOUT', 300)
+        self.jitter = config.get('CACHE_TTL_JITTER', 0.1)
+        self.lock_timeout = config.get('CACHE_LOCK_TIMEOUT', 5)
+        if bus is None:
+            url = config.get('CACHE_INVALIDATION_URL')
+            bus = RedisBus(url) if url else LocalBus()
+        self.bus = bus
+        self.bus.subscribe(self._invalidated)
+
+    def _invalidated(self, key):
+        with self._lock:
+            self._invalidations += 1
+        if key is None:
+            self.local.clear()
+        else:
+            self.local.delete(key)
+
+    def get_shared(self, key):
+        """
+        Value of a remote key that changes in place, kept locally up to
+        CACHE_LOCAL_TIMEOUT or until invalidate(key)
+        """
+        self.bus.listen()
+        value = self.local.get(key)
+        if value is None:
+            invalidations = self._invalidations
+            value = self.remote.get(key)
+            # Not kept when an invalidation may have overtaken the read
+            if value is not None and invalidations == self._invalidations:
+                self.local.set(key, value, self.local_timeout)
+        return value
+
+    def invalidate(self, key):
+        """
+        Drops the local copies of `key` in every process
+        """
+        self.local.delete(key)
+        self.bus.publish(key)
+
+    def clear(self):
+        self.local.clear()
+        self.remote.clear()
+
+    def set(self, key, value, timeout):
+        """
+        Stores `value`, fresh for `timeout` seconds minus up to
+        CACHE_TTL_JITTER of it (entries cached together do not expire
+        together), then stale for CACHE_STALE_TIMEOUT
+        """
+        fresh = timeout * (1 - self.jitter * random.random())
+        entry = (value, time.time() + fresh)
+        self.remote.set(key, entry, timeout=int(fresh + self.stale_timeout) + 1)
+        self.local.set(key, entry, fresh + self.stale_timeout)
+        return entry
+
+    def _keep_local(self, key, entry):
+        remaining = entry[1] + self.stale_timeout - time.time()
+        if remaining > 0:
+            self.local.set(key, entry, remaining)
+
+    def fetch(self, key, compute, timeout, cacheable=None):
+        """
+        Value of `key`, computed with compute() when missing or stale and
+        stored when cacheable(value), for `timeout` seconds or timeout() once
+        the value is computed
+        """
+        self.bus.listen()
+        entry = self.local.get(key)
+        if entry is None or entry[1] <= time.time():
+            entry = self.remote.get(key) or entry
+            if entry is not None:
+                self._keep_local(key, entry)
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if entry is not None:
+                return entry[0]
+            if flight.done.wait(self.lock_timeout) and flight.entry is not None:
+                return flight.entry[0]
+            return compute()
+        try:
+            value, flight.entry = self._load(key, compute, timeout, cacheable, entry)
+            return value
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def _load(self, key, compute, timeout, cacheable, stale):
+        lock_key = f"{key}:lock"
+        locked = self.remote.add(lock_key, 1, timeout=self.lock_timeout)
+        if not locked:
+            # Another process computes it
+            if stale is not None:
+                return stale[0], stale
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(0.02)
+                entry = self.remote.cache.get(key)
+                if entry is not None and entry[1] > time.time():
+                    self._keep_local(key, entry)
+                    return entry[0], entry
+        try:
+            value = compute()
+            if cacheable is not None and not cacheable(value):
+                return value, None
+            return value, self.set(key, value, timeout() if callable(timeout) else timeout)
+        finally:
+            if locked:
+                self.remote.delete(lock_key)
+
+    def cached(self, timeout=None, key=None, timeout_setting='CACHE_DEFAULT_TIMEOUT'):
+        """
+        Replacement of cache.cached for views, under key() (by default the
+        path and query string). Only successful responses are stored, already
+        serialized and compressed (encode_variants), with their ETag: a hit is
+        served without encoding anything. Responses without their own ETag
+        get one derived from the cache key, so a matching If-None-Match is
+        answered with a 304 before running the view or reading the cache
+        (suffixed with -replica when rendered from a replica that may lag,
+        see g.cache_timeout_cap, so that it never matches)
+        """
+        def _cached(f):
+            @wraps(f)
+            def __cached(*args, **kwargs):
+                cache_key = key() if key is not None else _view_key()
+                collection_etag = hashlib.sha1(cache_key.encode('utf-8')).hexdigest()
+                matched_etag = find_etag(request.if_none_match, collection_etag)
+                if matched_etag is not None:
+                    response = current_app.response_class(status=304)
+                    response.set_etag(matched_etag)
+                    response.vary.add('Accept-Encoding')
+                    return response
+
+                def render():
+                    response = make_response(f(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    etag = response.get_etag()[0] or collection_etag
+                    if (etag == collection_etag and g.get('cache_timeout_cap') is not None):
+                        # A replica may lag the user's last write: its body
+                        # never gets the collection ETag of the primary's
+                        etag = f"{collection_etag}-replica"
+                    return encode_variants(response.get_data(), response.mimetype), response.mimetype, etag
+
+                def entry_timeout():
+                    # Capped by the request, e.g. when read from a lagging replica
+                    cap = g.get('cache_timeout_cap')
+                    base = timeout or current_app.config[timeout_setting]
+                    return base if cap is None else min(base, cap)
+
+                cached = self.fetch(cache_key, render, entry_timeout,
+                                    cacheable=lambda value: isinstance(value, tuple))
+                if not isinstance(cached, tuple):
+                    return cached.make_conditional(request)
+                variants, mimetype, etag = cached
+                return serve_variant(current_app.response_class(status=200, mimetype=mimetype), variants, etag)
+            return __cached
+        return _cached
+
+
+layered_cache = LayeredCache(cache)
+
+
+def _generation_key(user_key):
+    return f"todos_generation:{user_key}"
+
+
+def get_user_generation(user_key):
+    """
+    Current generation of the user's cache namespace, every cached todo
+    list/detail of the user embeds it in its key
+    """
+    key = _generation_key(user_key)
+    generation = layered_cache.get_shared(key)
+    if generation is None:
+        # Seeded with a timestamp so that a lost counter never comes back to
+        # a generation that still has live entries
+        cache.add(key, time.time_ns() // 1000, timeout=0)
+        generation = layered_cache.get_shared(key)
+    return generation
+
+
+def bump_user_generation(user_key):
+    """
+    Invalidate all of the user's cached todo reads in O(1): entries of the
+    previous generation are never read again and just expire
+    """
+    key = _generation_key(user_key)
+    if not cache.add(key, time.time_ns() // 1000, timeout=0):
+        cache.cache.inc(key)
+    layered_cache.invalidate(key)
+
+
+def _args_hash():
+    args = sorted(request.args.items(multi=True))
+    return hashlib.md5(str(args).encode('utf-8')).hexdigest()
+
+
+def _view_key():
+    return f"view:{request.path}:{_args_hash()}"
+
+
+def _request_key(user_key):
+    # Suffixed since the entries hold their encoded variants with their freshness
+    return f"todos:{user_key}:{get_user_generation(user_key)}:{request.path}:{_args_hash()}:layered"
+
+
+def find_etag(etags, etag):
+    """
+    The variant of `etag` listed in the If-Match/If-None-Match `etags`, if any:
+    the ETag itself or, once encoded, the ETag suffixed with the content
+    coding ("<etag>:gzip", as Flask-Compress does)
+    """
+    for variant in [etag] + [f"{etag}:{encoding}" for encoding in ENCODERS]:
+        if etags.contains(variant):
+            return variant
+    return None
+
+
+def encode_variants(body, mimetype):
+    """
+    The body under every content coding enabled in COMPRESS_ALGORITHM, in
+    the server's order of preference, then as is ('identity'). Bodies
+    Flask-Compress would not compress are only kept as is.
+    """
+    config = current_app.config
+    variants = {}
+    if (mimetype in config.get('COMPRESS_MIMETYPES', ()) and len(body) >= config.get('COMPRESS_MIN_SIZE', 0)):
+        algorithms = config.get('COMPRESS_ALGORITHM', ())
+        if isinstance(algorithms, str):
+            algorithms = algorithms.split(',')
+        for encoding in (algorithm.strip() for algorithm in algorithms):
+            if (encoding in ENCODERS):
+                variants[encoding] = ENCODERS[encoding](body, config)
+    variants['identity'] = body
+    return variants
+
+
+def serve_variant(response, variants, etag):
+    """
+    Sets the variant accepted by the request as the body of `response`, as
+    is: Flask-Compress leaves the responses with a Content-Encoding alone
+    """
+    encoding = request.accept_encodings.best_match(list(variants), 'identity')
+    response.set_data(variants[encoding])
+    if (encoding != 'identity'):
+        response.headers['Content-Encoding'] = encoding
+        etag = f"{etag}:{encoding}"
+    elif (request.accept_encodings):
+        # Only codings without a stored variant accepted (deflate): served
+        # as is rather than compressed again on every hit under another ETag
+        response.headers['Content-Encoding'] = 'identity'
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response.make_conditional(request)
+
+
+def cached_per_user(timeout=None):
+    """
+    Like layered_cache.cached but namespaced by the user id and its
+    generation, the collection ETag thus following the user's todos
+    """
+    return layered_cache.cached(timeout, key=lambda: _request_key(current_user_id()),
+                                timeout_setting='CACHE_TODOS_TIMEOUT')
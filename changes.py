@@ -0,0 +1,95 @@
+from sqlalchemy import and_, delete, func, insert, or_, select, update
+from caching import bump_user_generation
+from models import Todo, TodoStats, TodoTombstone, db
+from serializers import TODO_COLUMNS, serialize_rows
+from utils import DEFAULT_CURSOR_LIMIT, MAX_CURSOR_LIMIT, decode_cursor, encode_cursor
+
+
+class SyncTokenExpired(Exception):
+    pass
+
+
+def record_deletions(user_id, deleted):
+    """
+    Tombstones of the user's deleted todos, `deleted` being (todo id,
+    revision) pairs
+    """
+    if (deleted):
+        db.session.execute(insert(TodoTombstone), [
+            {'user_id': user_id, 'todo_id': id_todo, 'revision': revision} for id_todo, revision in deleted])
+
+
+def _after(revision_column, id_column, position):
+    revision, id_todo = position
+    return or_(revision_column > revision, and_(revision_column == revision, id_column > id_todo))
+
+
+def todo_changes(user_id, since=None, limit=DEFAULT_CURSOR_LIMIT):
+    """
+    The user's todos written and deleted after the `since` sync token, in
+    revision order, with the token to resume from. Without a token the
+    feed starts with the live todos (no tombstones): a full sync.
+    Both reads seek the (user_id, revision) indexes, a page costs the same
+    whatever the size of the collection.
+    """
+    limit = max(1, min(limit, MAX_CURSOR_LIMIT))
+    if (since is None):
+        position = (-1, 0)
+        # The tombstones up to the revision the full sync started from are of
+        # todos it never listed: their compaction does not expire its tokens
+        horizon = db.session.scalar(select(TodoStats.revision).where(TodoStats.user_id == user_id)) or 0
+    else:
+        value, id_todo = decode_cursor(since, 'revision')
+        revision, horizon = value if isinstance(value, list) else (value, value)
+        position = (revision, id_todo)
+        compacted = db.session.scalar(select(TodoStats.compacted_revision).where(
+            TodoStats.user_id == user_id))
+        if (compacted is not None and max(revision, horizon) < compacted):
+            # Tombstones the client did not see were compacted
+            raise SyncTokenExpired("SyncTokenExpired")
+    rows = db.session.execute(select(*TODO_COLUMNS, Todo.revision).where(
+        Todo.user_id == user_id, _after(Todo.revision, Todo.id, position)).order_by(
+        Todo.revision, Todo.id).limit(limit + 1)).all()
+    changes = [(row.revision, row.id, todo) for row, todo in zip(rows, serialize_rows(rows))]
+    if (since is not None):
+        tombstones = db.session.execute(select(TodoTombstone.revision, TodoTombstone.todo_id).where(
+            TodoTombstone.user_id == user_id,
+            _after(TodoTombstone.revision, TodoTombstone.todo_id, position)).order_by(
+            TodoTombstone.revision, TodoTombstone.todo_id).limit(limit + 1)).all()
+        changes += [(revision, id_todo, None) for revision, id_todo in tombstones]
+        changes.sort(key=lambda change: change[:2])
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    if (changes):
+        position = changes[-1][:2]
+    if (changes or since is None):
+        revision = position[0]
+        since = encode_cursor('revision', [revision, horizon] if horizon > revision else revision, position[1])
+    return {"requestStatus": True, "count": len(changes), "has_more": has_more, "next_since": since,
+            "changes": [dict(todo, revision=revision, deleted=False) if todo is not None else
+                        {'id': id_todo, 'revision': revision, 'deleted': True}
+                        for revision, id_todo, todo in changes]}
+
+
+def compact_tombstones(before, batch_size=1000):
+    """
+    Deletes the tombstones of the todos deleted before `before`, returns how
+    many. The feed of a user then answers 410 to the tokens older than
+    their last compacted tombstone.
+    """
+    removed = 0
+    while True:
+        horizons = db.session.execute(select(TodoTombstone.user_id, func.max(TodoTombstone.revision)).where(
+            TodoTombstone.deleted_at < before).group_by(TodoTombstone.user_id).limit(batch_size)).all()
+        if (not horizons):
+            return removed
+        for user_id, revision in horizons:
+            db.session.execute(update(TodoStats).where(
+                TodoStats.user_id == user_id, TodoStats.compacted_revision < revision).values(
+                compacted_revision=revision))
+            removed += db.session.execute(delete(TodoTombstone).where(
+                TodoTombstone.user_id == user_id, TodoTombstone.revision <= revision)).rowcount
+        db.session.commit()
+        # Their cached feeds still answer the expired tokens
+        for user_id, _ in horizons:
+            bump_user_generation(user_id)
@@ -7,12 +7,83 @@ class Config(object):
     CSRF_ENABLED = True
     SECRET_KEY = os.environ['SECRET_KEY']
     SQLALCHEMY_DATABASE_URI = os.environ['SQLALCHEMY_DATABASE_URI']
+    # Per worker process, sized for the gunicorn threads of a worker
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+        'pool_timeout': 10,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+    }
+    # Read replicas (comma separated URLs): GET requests read from them, see
+    # replicas.ReadReplicas
+    SQLALCHEMY_BINDS = {f'replica_{index}': uri for index, uri in enumerate(
+        filter(None, os.environ.get('SQLALCHEMY_REPLICA_URIS', '').split(',')))}
+    # Seconds during which a user who wrote reads from the primary, more
+    # than the replication lag
+    DB_REPLICA_STICKINESS = int(os.environ.get('DB_REPLICA_STICKINESS', 5))
+    # Then, up to that many seconds after the write, the responses read from
+    # a replica (that may still lag it) are only cached DB_REPLICA_STICKINESS
+    DB_REPLICA_LAG_WINDOW = int(os.environ.get('DB_REPLICA_LAG_WINDOW', 60))
+    DB_REPLICA_RETRY_INTERVAL = 30
     CACHE_TYPE = os.environ['CACHE_TYPE']
     CACHE_REDIS_HOST = os.environ['CACHE_REDIS_HOST']
     CACHE_REDIS_PORT = os.environ['CACHE_REDIS_PORT']
     CACHE_REDIS_DB = os.environ['CACHE_REDIS_DB']
     CACHE_REDIS_URL = os.environ['CACHE_REDIS_URL']
-    CACHE_DEFAULT_TIMEOUT = os.environ['CACHE_DEFAULT_TIMEOUT']
+    CACHE_DEFAULT_TIMEOUT = int(os.environ['CACHE_DEFAULT_TIMEOUT'])
+    CACHE_TODOS_TIMEOUT = 3600
+    # In-process tier in front of the cache, invalidated through the Redis
+    # pub/sub (only within the process without Redis)
+    CACHE_INVALIDATION_URL = os.environ.get(
+        'CACHE_INVALIDATION_URL', CACHE_REDIS_URL if CACHE_TYPE.lower() in ('redis', 'rediscache') else None)
+    CACHE_LOCAL_MAX_ENTRIES = int(os.environ.get('CACHE_LOCAL_MAX_ENTRIES', 1024))
+    CACHE_LOCAL_MAX_BYTES = int(os.environ.get('CACHE_LOCAL_MAX_BYTES', 64 * 1024 * 1024))
+    CACHE_LOCAL_TIMEOUT = 60
+    # Expired entries are still served that long while one request
+    # recomputes them, their timeouts are shortened by up to 10% at random
+    CACHE_STALE_TIMEOUT = 300
+    CACHE_TTL_JITTER = 0.1
+    CACHE_LOCK_TIMEOUT = 5
+    TODOS_BATCH_MAX_ITEMS = 500
+    # Bodies are refused (413) above it, before being read: enough for a
+    # full batch of TODOS_BATCH_MAX_ITEMS todos
+    MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 1024 * 1024))
+    # Counters shared by every worker: the Redis of the cache, or a local
+    # SQLite file (ratelimit.SQLiteStorage) on a single host without Redis
+    RATELIMIT_STORAGE_URI = os.environ.get(
+        'RATELIMIT_STORAGE_URI',
+        CACHE_REDIS_URL if CACHE_TYPE.lower() in ('redis', 'rediscache') else 'sqlite:///ratelimit.db')
+    RATELIMIT_STRATEGY = 'moving-window'
+    RATELIMIT_KEY_PREFIX = 'ratelimit'
+    # Streams are compressed chunk by chunk by the handler, never buffered
+    COMPRESS_STREAMS = False
+    REMINDER_LEAD = timedelta(hours=1)
+    REMINDER_LOOKBACK = timedelta(days=1)
+    REMINDER_BATCH_SIZE = 500
+    # Deleted todos stay in the change feed that long, clients that did not
+    # sync meanwhile get a 410 and start over
+    TOMBSTONE_RETENTION = timedelta(days=30)
+    MAIL_TRANSPORT = os.environ.get('MAIL_TRANSPORT', 'ses')
+    MAIL_FILE_PATH = os.environ.get('MAIL_FILE_PATH', 'outbox.ndjson')
+    MAIL_QUEUE_SIZE = 1000
+    MAIL_WORKERS = 2
+    MAIL_MAX_RETRIES = 5
+    # werkzeug method string, stored hashes with another one are upgraded at login
+    PASSWORD_HASH_METHOD = 'scrypt:32768:8:1'
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_MAX_PENDING = 8
+    PASSWORD_HASH_TIMEOUT = 10
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_SINK = os.environ.get('LOG_SINK', 'cloudwatch')
+    LOG_FILE_PATH = os.environ.get('LOG_FILE_PATH', 'api.log')
+    LOG_SHIPPED_LOGGERS = ['app', 'mailing', 'reminders', 'scheduler']
+    LOG_QUEUE_SIZE = 10000
+    LOG_ROUTE_LEVELS = {}
+    LOG_ROUTE_SAMPLING = {'api.get_todos': 0.1, 'api.get_one_todo': 0.1}
+    # Shared by the gunicorn workers so that /metrics aggregates all of them
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = 5
     JWT_SECRET_KEY = SECRET_KEY
     JWT_TOKEN_LOCATION = "cookies"
     JWT_COOKIE_SECURE = False
@@ -20,6 +91,8 @@ class Config(object):
     JWT_ACCESS_CSRF_HEADER_NAME = "X-CSRF-TOKEN"
     JWT_EXPIRATION_DELTA = timedelta(seconds=86400)
     JWT_AUTH_USERNAME_KEY = 'email'
+    IDENTITY_CACHE_TTL = 300
+    IDENTITY_CACHE_MAX_ENTRIES = 10000
     ALLOWED_HOSTS = ["*"]
     AWS_LOG_GROUP = os.environ['AWS_LOG_GROUP']
     AWS_LOG_STREAM = os.environ['AWS_LOG_STREAM']
@@ -30,13 +103,43 @@ class ProductionConfig(Config):
     DEBUG = False
     ALLOWED_HOSTS = os.environ['ALLOWED_HOSTS'].split(',')
     JWT_COOKIE_SECURE = True
+    SQLALCHEMY_ENGINE_OPTIONS = dict(Config.SQLALCHEMY_ENGINE_OPTIONS,
+                                     pool_size=int(os.environ.get('DB_POOL_SIZE', 10)),
+                                     max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)))
+    PASSWORD_HASH_METHOD = 'scrypt:65536:8:1'
 
 
 class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite:///test.db'
+    SQLALCHEMY_ENGINE_OPTIONS = {'pool_pre_ping': False}
+    SQLALCHEMY_BINDS = {}
     CACHE_REDIS_HOST = "redis"
     CACHE_REDIS_URL = "redis://redis:6379/0"
+    MAIL_TRANSPORT = 'memory'
+    RATELIMIT_STORAGE_URI = 'memory://'
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    PASSWORD_HASH_WORKERS = 1
+    LOG_SINK = 'file'
+    LOG_FILE_PATH = 'test.log'
+    LOG_ROUTE_SAMPLING = {}
 
 
 class DevelopmentConfig(Config):
     DEBUG = True
+
+
+class BenchmarkConfig(Config):
+    """
+    Production settings on a local SQLite database, with mail and logs kept
+    local and no rate limits, for `python -m benchmarks.load`
+    """
+    DEBUG = False
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'BENCHMARK_DATABASE_URI', 'sqlite:///' + os.path.join(basedir, 'bench_api.db'))
+    SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 20, 'max_overflow': 0}
+    MAIL_TRANSPORT = 'memory'
+    RATELIMIT_ENABLED = False
+    RATELIMIT_STORAGE_URI = 'memory://'
+    LOG_SINK = 'file'
+    LOG_FILE_PATH = 'bench.log'
+    LOG_LEVEL = 'WARNING'
@@ -0,0 +1,68 @@
+import csv
+import io
+import json
+import zlib
+from sqlalchemy import select
+from models import Todo, db
+from utils import DEADLINE_FORMAT
+
+EXPORT_COLUMNS = ['id', 'title', 'description',
+                  'completed', 'user_id', 'deadline']
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def _rows(user_id, batch_size):
+    """
+    Rows of the user streamed from a server-side cursor, only `batch_size`
+    of them are held in memory at a time
+    """
+    query = select(*[getattr(Todo, name) for name in EXPORT_COLUMNS]).where(
+        Todo.user_id == user_id).order_by(Todo.id).execution_options(
+        stream_results=True, yield_per=batch_size)
+    for partition in db.session.execute(query).partitions():
+        yield partition
+
+
+def _ndjson(partition):
+    return ''.join(json.dumps({
+        'id': id_todo, 'title': title, 'description': description, 'completed': completed,
+        'user_id': user_id, 'deadline': deadline.strftime(DEADLINE_FORMAT) if deadline else None
+    }, ensure_ascii=False) + '\n' for id_todo, title, description, completed, user_id, deadline in partition)
+
+
+def _csv(partition):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows((id_todo, title, description, completed, user_id,
+                      deadline.strftime(DEADLINE_FORMAT) if deadline else '')
+                     for id_todo, title, description, completed, user_id, deadline in partition)
+    return buffer.getvalue()
+
+
+def export_todos(user_id, export_format, batch_size=1000):
+    """
+    Encoded chunks (one per batch of rows) of all the todos of the user
+    """
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue().encode('utf-8')
+    encode = _csv if export_format == 'csv' else _ndjson
+    for partition in _rows(user_id, batch_size):
+        yield encode(partition).encode('utf-8')
+
+
+def gzip_stream(chunks, level=6):
+    """
+    Gzip a stream chunk by chunk, each chunk is flushed so that the client
+    receives data as soon as it is produced
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
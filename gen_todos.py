@@ -1,69 +1,247 @@
-from datetime import datetime
+"""
+Bulk loader of fake users and todos for capacity testing.
+
+    python gen_todos.py --users 1000 --todos 10000000
+    python gen_todos.py --url sqlite:///bench.db --todos 1000000 --user-distribution zipf
+
+Rows are generated batch by batch in a pool of processes out of word pools
+built once, and written with COPY on Postgres, with one executemany
+transaction per batch on SQLite (written by the parent process, SQLite has a
+single writer) and with multi-row INSERTs elsewhere. The users share one
+password hash (of --password), upgraded at their first login.
+"""
+import argparse
+import csv
+from datetime import datetime, timedelta
+import io
+import itertools
+import multiprocessing
+import os
+import random
+import secrets
 import time
+from dotenv import load_dotenv
 from faker import Faker
+from sqlalchemy import create_engine, insert, select, text
 from werkzeug.security import generate_password_hash
-from models import db
-from secrets import token_hex
-from random import choices
-from app import app
-from models import Todo, User
-import threading
-
-fake = Faker()
-users = []
-TOTAL_TODOS = 100_000
-THREAD_COUNT = 4
-
-
-def generate_todo(id):
-    with app.app_context():
-
-        todo = Todo(
-            title=fake.sentence(),
-            description=fake.text(),
-            completed=fake.boolean(),
-            user_id=choices(users)[0].id,
-            deadline=fake.date_between_dates(date_start=datetime(
-                2023, 11, 16), date_end=datetime(2024, 4, 10)),
-        )
-        db.session.add(todo)
-        db.session.commit()
-        print(f"{id} {todo}")
-
-
-def create_todos_in_threads(start_id, end_id):
-    for todo_id in range(start_id, end_id):
-        generate_todo(todo_id)
-
-
-def run_threaded_function():
-    threads = []
-    todos_per_thread = TOTAL_TODOS // THREAD_COUNT
-
-    for i in range(THREAD_COUNT):
-        start_id = i * todos_per_thread
-        end_id = (i + 1) * todos_per_thread if i < THREAD_COUNT - \
-            1 else TOTAL_TODOS
-        thread = threading.Thread(
-            target=create_todos_in_threads, args=(start_id, end_id))
-        threads.append(thread)
-
-    for thread in threads:
-        thread.start()
-
-    for thread in threads:
-        thread.join()
-
-
-with app.app_context():
-    start_time = time.time()
-    for i in range(3):
-        user = User(name=fake.name(), email=fake.email(), password=generate_password_hash(
-            f"User{str(i).zfill(5)}"), role='simple', token=token_hex(16))
-        db.session.add(user)
-        db.session.commit()
-        users.append(user)
-
-    run_threaded_function()
-    end_time = time.time()
-    print(f"Time taken: {end_time - start_time} seconds")
+from models import TODO_SEARCH_DDL, Todo, TodoStats, User, db
+from stats import counted_todos
+
+# What SQLAlchemy stores in SQLite DATETIME columns
+SQLITE_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+TODO_COLUMNS = ('title', 'description', 'completed', 'user_id', 'created_at', 'updated_at', 'deadline', 'revision')
+
+
+def parse_args(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--url', default=os.environ.get('SQLALCHEMY_DATABASE_URI'),
+                        help='database URL (default: SQLALCHEMY_DATABASE_URI)')
+    parser.add_argument('--users', type=int, default=3)
+    parser.add_argument('--todos', type=int, default=100_000)
+    parser.add_argument('--batch-size', type=int, default=10_000)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--user-distribution', choices=('uniform', 'zipf'), default='uniform',
+                        help='how todos are spread over the users')
+    parser.add_argument('--zipf-exponent', type=float, default=1.1)
+    parser.add_argument('--completed-ratio', type=float, default=0.5)
+    parser.add_argument('--no-deadline-ratio', type=float, default=0.1)
+    parser.add_argument('--deadline-start', type=datetime.fromisoformat, default=datetime(2023, 11, 16))
+    parser.add_argument('--deadline-end', type=datetime.fromisoformat, default=datetime(2024, 4, 10))
+    parser.add_argument('--create-schema', action='store_true',
+                        help='create the tables first (instead of `flask db upgrade`)')
+    args = parser.parse_args(argv)
+    if not args.url:
+        parser.error('--url or SQLALCHEMY_DATABASE_URI is required')
+    return args
+
+
+def create_users(engine, args):
+    """
+    Inserts args.users users in one statement, returns their ids
+    """
+    password = generate_password_hash(args.password)
+    run = secrets.token_hex(4)
+    rows = [{'name': f'User {run}-{i}', 'email': f'user{i}.{run}@example.com', 'password': password,
+             'token': secrets.token_hex(16), 'emailChecked': True, 'role': 'simple', 'has_subscribed': False}
+            for i in range(args.users)]
+    with engine.begin() as connection:
+        connection.execute(insert(User.__table__), rows)
+        return connection.execute(select(User.id).where(User.email.like(f'%.{run}@example.com'))
+                                  .order_by(User.id)).scalars().all()
+
+
+class BatchGenerator:
+    """
+    Builds rows of TODO_COLUMNS a batch at a time: every random draw of a
+    batch is one `choices` call over precomputed pools instead of Faker calls
+    per row
+    """
+
+    def __init__(self, args, user_ids):
+        self.seed = args.seed
+        self.batch_size = args.batch_size
+        fake = Faker()
+        fake.seed_instance(0)
+        words = sorted(set(fake.words(nb=2000)))
+        self.titles = [' '.join(random.Random(i).choices(words, k=5)).capitalize() for i in range(5000)]
+        self.descriptions = [' '.join(random.Random(-i).choices(words, k=25)).capitalize() + '.'
+                             for i in range(5000)]
+        self.user_ids = user_ids
+        if args.user_distribution == 'zipf':
+            weights = [1 / rank ** args.zipf_exponent for rank in range(1, len(user_ids) + 1)]
+        else:
+            weights = [1] * len(user_ids)
+        self.user_cum_weights = list(itertools.accumulate(weights))
+        self.completed_ratio = args.completed_ratio
+        self.no_deadline_ratio = args.no_deadline_ratio
+        span = int((args.deadline_end - args.deadline_start).total_seconds() // 60)
+        self.deadlines = [args.deadline_start + timedelta(minutes=minute)
+                          for minute in range(0, max(span, 1), 15)]
+
+    def batch(self, index, size):
+        # Seeded per batch, so a --seed run does not depend on which process
+        # generated which batch
+        rng = random.Random(None if self.seed is None else self.seed * 1_000_003 + index)
+        # Unique across batches, hence per user as the change feed needs
+        first_revision = index * self.batch_size + 1
+        now = datetime.utcnow()
+        deadlines = [None if draw < self.no_deadline_ratio else deadline for draw, deadline in
+                     zip((rng.random() for _ in range(size)), rng.choices(self.deadlines, k=size))]
+        return list(zip(rng.choices(self.titles, k=size), rng.choices(self.descriptions, k=size),
+                        [rng.random() < self.completed_ratio for _ in range(size)],
+                        rng.choices(self.user_ids, cum_weights=self.user_cum_weights, k=size),
+                        itertools.repeat(now), itertools.repeat(now), deadlines,
+                        range(first_revision, first_revision + size)))
+
+
+def copy_rows(connection, rows):
+    """
+    COPY FROM STDIN on Postgres (psycopg2 connection)
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['' if value is None else value for value in row])
+    buffer.seek(0)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY todo ({', '.join(TODO_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    connection.commit()
+
+
+def write_rows(engine, rows):
+    if engine.dialect.name == 'postgresql':
+        connection = engine.raw_connection()
+        try:
+            copy_rows(connection.dbapi_connection, rows)
+        finally:
+            connection.close()
+    elif engine.dialect.name == 'sqlite':
+        connection = engine.raw_connection()
+        try:
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.executemany(
+                f"INSERT INTO todo ({', '.join(TODO_COLUMNS)}) VALUES ({', '.join('?' * len(TODO_COLUMNS))})",
+                [[value.strftime(SQLITE_DATETIME_FORMAT) if isinstance(value, datetime) else value
+                  for value in row] for row in rows])
+            connection.commit()
+        finally:
+            connection.close()
+    else:
+        with engine.begin() as connection:
+            connection.execute(insert(Todo.__table__), [dict(zip(TODO_COLUMNS, row)) for row in rows])
+
+
+# Per-process state of the pool workers, set by init_worker
+_worker = {}
+
+
+def init_worker(args, user_ids, writes):
+    _worker['generator'] = BatchGenerator(args, user_ids)
+    _worker['engine'] = create_engine(args.url) if writes else None
+
+
+def generate(task):
+    return _worker['generator'].batch(*task)
+
+
+def generate_and_write(task):
+    rows = _worker['generator'].batch(*task)
+    write_rows(_worker['engine'], rows)
+    return len(rows)
+
+
+def load_todos(args, user_ids):
+    """
+    Yields the number of rows written after each batch
+    """
+    sizes = [args.batch_size] * (args.todos // args.batch_size)
+    if args.todos % args.batch_size:
+        sizes.append(args.todos % args.batch_size)
+    engine = create_engine(args.url)
+    sqlite = engine.dialect.name == 'sqlite'
+    with multiprocessing.get_context('spawn').Pool(
+            args.processes, initializer=init_worker, initargs=(args, user_ids, not sqlite)) as pool:
+        if sqlite:
+            fts_suspended = suspend_sqlite_fts(engine)
+            try:
+                for rows in pool.imap_unordered(generate, enumerate(sizes)):
+                    write_rows(engine, rows)
+                    yield len(rows)
+            finally:
+                if fts_suspended:
+                    rebuild_sqlite_fts(engine)
+        else:
+            yield from pool.imap_unordered(generate_and_write, enumerate(sizes))
+    engine.dispose()
+
+
+def suspend_sqlite_fts(engine):
+    """
+    Drops the trigger indexing every inserted todo for full-text search,
+    indexing the whole table once at the end is cheaper
+    """
+    with engine.begin() as connection:
+        if connection.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'trigger' "
+                                   "AND name = 'todo_fts_ai'")).first() is None:
+            return False
+        connection.execute(text('DROP TRIGGER todo_fts_ai'))
+    return True
+
+
+def rebuild_sqlite_fts(engine):
+    with engine.begin() as connection:
+        connection.execute(text(TODO_SEARCH_DDL['sqlite'][1]))
+        connection.execute(text("INSERT INTO todo_fts(todo_fts) VALUES ('rebuild')"))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    engine = create_engine(args.url)
+    if args.create_schema:
+        db.metadata.create_all(engine)
+    start = time.perf_counter()
+    user_ids = create_users(engine, args)
+    print(f"{len(user_ids)} users created in {time.perf_counter() - start:.2f}s")
+    engine.dispose()
+
+    start = time.perf_counter()
+    written = 0
+    for count in load_todos(args, user_ids):
+        written += count
+        elapsed = time.perf_counter() - start
+        print(f"\r{written}/{args.todos} todos, {written / elapsed:,.0f} rows/s", end='', flush=True)
+    # The rows bypassed the API, the users' counters are counted once at the end
+    engine = create_engine(args.url)
+    with engine.begin() as connection:
+        connection.execute(insert(TodoStats).from_select(
+            ['user_id', 'total', 'completed', 'revision'], counted_todos(user_ids)))
+    engine.dispose()
+    elapsed = time.perf_counter() - start
+    print(f"\n{written} todos written in {elapsed:.2f}s ({written / max(elapsed, 1e-9):,.0f} rows/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Production gunicorn settings, loaded by `gunicorn -c gunicorn.conf.py 'app:create_app()'`.
+Every value can be overridden from the environment.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# gthread by default: threads overlap the database and SES waits of a worker
+# while the processes spread the CPU bound work over the cores. gevent is
+# optional (pip install gevent psycogreen).
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+if worker_class == 'gevent':
+    # The application is preloaded in the master, it must be patched before
+    # it is imported
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        pass
+
+# The app is built once in the master and the workers are forked from it.
+# The reminders are sent by their own process (scheduler.py), not by the
+# web workers.
+preload_app = True
+
+# Recycle workers to bound memory growth, with jitter so that they do not all
+# restart at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Every worker dumps its metrics there so that /metrics sums all of them
+os.environ.setdefault('METRICS_DIR', os.path.join('/tmp', 'ultra-api-metrics'))
+
+accesslog = None
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def post_fork(server, worker):
+    # Connections opened by the master while importing the app must not be
+    # shared with the workers: drop the inherited pools without closing their
+    # sockets, each worker opens its own connections
+    from models import db
+    app = server.app.wsgi()
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def on_starting(server):
+    # The dumps of a previous run are not part of this one
+    from metrics import reset_metrics_dir
+    reset_metrics_dir(os.environ['METRICS_DIR'])
+
+
+def child_exit(server, worker):
+    # Recycled workers are folded into one aggregate dump
+    from metrics import fold_worker_metrics
+    fold_worker_metrics(os.environ['METRICS_DIR'], worker.pid)
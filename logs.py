@@ -0,0 +1,226 @@
+from datetime import datetime, timezone
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from flask import g, has_request_context, request
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Structured JSON lines, a record is serialized only once however many
+    sinks write it
+    """
+
+    def format(self, record):
+        serialized = getattr(record, 'json_message', None)
+        if serialized is None:
+            payload = record.msg if isinstance(record.msg, dict) else {
+                'message': record.getMessage()}
+            entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+                     'level': record.levelname, 'logger': record.name}
+            entry.update(payload)
+            if record.exc_text or record.exc_info:
+                entry['exc_info'] = record.exc_text or self.formatException(record.exc_info)
+            serialized = json.dumps(entry, default=str, ensure_ascii=False)
+            record.json_message = serialized
+        return serialized
+
+
+class RouteFilter(logging.Filter):
+    """
+    Per-endpoint level overrides and sampling, warnings and errors are never
+    sampled out
+    """
+
+    def __init__(self, levels, sampling):
+        super().__init__()
+        self.levels = {endpoint: logging.getLevelName(level) if isinstance(level, str) else level
+                       for endpoint, level in levels.items()}
+        self.sampling = sampling
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not has_request_context():
+            return True
+        endpoint = request.endpoint
+        if record.levelno < self.levels.get(endpoint, logging.NOTSET):
+            return False
+        rate = self.sampling.get(endpoint, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to a background listener without ever blocking the request
+    thread: debug records are dropped first when the queue fills up, then
+    info records, and warnings only wait briefly for room.
+    The listener is started lazily in the process that logs (threads do not
+    survive a gunicorn fork).
+    """
+
+    def __init__(self, log_queue, sinks, high_water=0.8):
+        super().__init__(log_queue)
+        self.sinks = sinks
+        self.high_water = int(log_queue.maxsize * high_water)
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._listener = QueueListener(
+                    self.queue, *self.sinks, respect_handler_level=True)
+                self._listener.start()
+                self._pid = os.getpid()
+
+    def stop(self):
+        if self._listener is not None and self._pid == os.getpid():
+            try:
+                self._listener.stop()
+            except queue.Full:
+                # The listener thread is a daemon, it dies with the process
+                pass
+            self._pid = None
+
+    def prepare(self, record):
+        # Formatting is left to the listener, only the arguments are merged
+        # so that the record does not hold references to request objects
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self.start()
+        size = self.queue.qsize()
+        if (record.levelno < logging.INFO and size >= self.high_water) or \
+                (record.levelno < logging.WARNING and size >= self.queue.maxsize):
+            self.dropped += 1
+            return
+        try:
+            if record.levelno < logging.WARNING:
+                self.queue.put_nowait(record)
+            else:
+                self.queue.put(record, timeout=0.1)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LazyHandler(logging.Handler):
+    """
+    Builds its handler (the CloudWatch one and its boto3 client) on the
+    first record, in the listener thread, instead of at startup. A handler
+    that cannot be built is replaced by the fallback one.
+    """
+
+    def __init__(self, factory, fallback, console):
+        super().__init__()
+        self.factory = factory
+        self.fallback = fallback
+        self.console = console
+        self.handler = None
+
+    def setFormatter(self, formatter):
+        super().setFormatter(formatter)
+        if self.handler is not None:
+            self.handler.setFormatter(formatter)
+
+    def build(self):
+        try:
+            handler = self.factory()
+        except Exception as e:
+            # CloudWatch unreachable (or not configured): keep the logs locally
+            self.console.handle(logging.makeLogRecord(
+                {'msg': {'message': 'cloudwatch_unavailable', 'error': str(e)}, 'levelno': logging.WARNING,
+                 'levelname': 'WARNING', 'name': __name__}))
+            handler = self.fallback()
+        handler.setFormatter(self.formatter)
+        return handler
+
+    def emit(self, record):
+        if self.handler is None:
+            self.handler = self.build()
+        self.handler.handle(record)
+
+    def flush(self):
+        if self.handler is not None:
+            self.handler.flush()
+
+    def close(self):
+        if self.handler is not None:
+            self.handler.close()
+        super().close()
+
+
+def build_sinks(app):
+    config = app.config
+    formatter = JsonFormatter()
+    console = logging.StreamHandler(sys.stderr)
+    console.setFormatter(formatter)
+    sinks = [console]
+
+    def file_handler():
+        return logging.FileHandler(config.get('LOG_FILE_PATH', 'api.log'), encoding='utf-8', delay=True)
+
+    def cloudwatch_handler():
+        from watchtower import CloudWatchLogHandler
+        return CloudWatchLogHandler(
+            log_group_name=config['AWS_LOG_GROUP'], log_stream_name=config['AWS_LOG_STREAM'])
+
+    if config.get('LOG_SINK', 'cloudwatch') == 'cloudwatch':
+        shipped = LazyHandler(cloudwatch_handler, file_handler, console)
+    else:
+        shipped = file_handler()
+    shipped.setFormatter(formatter)
+    shipped_loggers = tuple(config.get('LOG_SHIPPED_LOGGERS', ()))
+    shipped.addFilter(lambda record: record.name.split('.')[0] in shipped_loggers)
+    sinks.append(shipped)
+    return sinks
+
+
+def init_logging(app):
+    """
+    Route every log record through a bounded queue to the console and the
+    CloudWatch (or file) sink, and log the duration of each request
+    """
+    config = app.config
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=config.get('LOG_QUEUE_SIZE', 10000)),
+                                      build_sinks(app))
+    handler.addFilter(RouteFilter(config.get('LOG_ROUTE_LEVELS', {}),
+                                  config.get('LOG_ROUTE_SAMPLING', {})))
+    root = logging.getLogger()
+    for existing in [h for h in root.handlers if isinstance(h, NonBlockingQueueHandler)]:
+        existing.stop()
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(config.get('LOG_LEVEL', 'INFO'))
+    app.extensions['log_handler'] = handler
+
+    request_logger = logging.getLogger('app.requests')
+
+    @app.before_request
+    def start_timer():
+        g.request_started_at = time.perf_counter()
+
+    @app.after_request
+    def log_request(response):
+        started_at = g.pop('request_started_at', None)
+        if started_at is not None:
+            request_logger.info({"message": 'request', "endpoint": request.endpoint, "method": request.method,
+                                 "path": request.path, "status": response.status_code,
+                                 "duration_ms": round((time.perf_counter() - started_at) * 1000, 3)})
+        return response
+
+    return handler
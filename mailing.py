@@ -1,31 +1,219 @@
-from botocore.exceptions import ClientError
+import json
+import logging
 import os
-import boto3
+import queue
+import random
+import threading
+import time
 from dotenv import load_dotenv
 load_dotenv()
-session = boto3.Session(
-    aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-    aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
-    region_name=os.environ['AWS_REGION']
-)
+
+logger = logging.getLogger(__name__)
+
+# SES errors that retrying will not fix
+PERMANENT_SES_ERRORS = {'MessageRejected', 'MailFromDomainNotVerified',
+                        'InvalidParameterValue', 'AccountSendingPausedException'}
+
+
+class PermanentEmailError(Exception):
+    pass
+
+
+class SESTransport:
+    """
+    Sends through SES with one long-lived client shared by every worker
+    (boto3 clients are thread-safe), created on first use.
+    send_batch returns the (message, error) pairs that failed
+    """
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    # Imported on first use: boto3 adds ~80ms to the import of every process
+                    import boto3
+                    session = boto3.Session(
+                        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+                        region_name=os.environ['AWS_REGION']
+                    )
+                    self._client = session.client('ses')
+        return self._client
+
+    def send(self, message):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.send_email(
+                Source=message['sender'],
+                Destination={'ToAddresses': [message['recipient']]},
+                Message={
+                    'Subject': {'Data': message['subject']},
+                    'Body': {'Html': {'Data': message['body']}},
+                }
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] in PERMANENT_SES_ERRORS:
+                raise PermanentEmailError(e.response['Error']['Message'])
+            raise
+
+    def send_batch(self, messages):
+        # SendEmail takes a single personalised message per call, batching
+        # only saves the queue round trips and reuses the connection
+        failures = []
+        for message in messages:
+            try:
+                self.send(message)
+            except Exception as e:
+                failures.append((message, e))
+        return failures
+
+
+class MemoryTransport:
+    """
+    Keeps sent messages in `outbox`, for tests
+    """
+
+    def __init__(self):
+        self.outbox = []
+        self._lock = threading.Lock()
+
+    def send_batch(self, messages):
+        with self._lock:
+            self.outbox.extend(messages)
+        return []
+
+
+class FileTransport:
+    """
+    Appends sent messages as JSON lines to a file, for local runs
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send_batch(self, messages):
+        with self._lock, open(self.path, 'a', encoding='utf-8') as outbox:
+            for message in messages:
+                outbox.write(json.dumps(message, ensure_ascii=False) + '\n')
+        return []
+
+
+TRANSPORTS = {
+    'ses': lambda config: SESTransport(),
+    'memory': lambda config: MemoryTransport(),
+    'file': lambda config: FileTransport(config['MAIL_FILE_PATH']),
+}
+
+
+class Mailer:
+    """
+    Background email dispatcher: a bounded queue drained by a small pool of
+    worker threads sharing one transport, with retries and exponential backoff
+    """
+
+    def __init__(self, app=None):
+        self.transport = None
+        self._queue = None
+        self._workers = []
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.transport = TRANSPORTS[config.get('MAIL_TRANSPORT', 'ses')](config)
+        self.worker_count = config.get('MAIL_WORKERS', 2)
+        self.batch_size = config.get('MAIL_BATCH_SIZE', 10)
+        self.max_retries = config.get('MAIL_MAX_RETRIES', 5)
+        self.backoff = config.get('MAIL_RETRY_BACKOFF', 1.0)
+        self._queue = queue.Queue(maxsize=config.get('MAIL_QUEUE_SIZE', 1000))
+        app.extensions['mailer'] = self
+
+    def _start(self):
+        # Workers are started lazily, in the process that sends (threads do
+        # not survive a gunicorn fork)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._workers = [threading.Thread(target=self._work, daemon=True, name=f'mailer-{i}')
+                             for i in range(self.worker_count)]
+            for worker in self._workers:
+                worker.start()
+            self._pid = os.getpid()
+
+    def enqueue(self, sender, recipient, subject, body):
+        """
+        Queue an email without waiting for it to be sent, returns False when
+        the queue is full
+        """
+        self._start()
+        try:
+            self._queue.put_nowait({'sender': sender, 'recipient': recipient,
+                                    'subject': subject, 'body': body})
+            return True
+        except queue.Full:
+            logger.error({"message": 'mail_queue_full', "recipient": recipient})
+            return False
+
+    def join(self):
+        """
+        Wait until every queued email has been handled
+        """
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            messages = [self._queue.get()]
+            while len(messages) < self.batch_size:
+                try:
+                    messages.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._send(messages)
+            finally:
+                for _ in messages:
+                    self._queue.task_done()
+
+    def _send(self, messages):
+        """
+        Send a batch, only the messages that failed with a transient error
+        are retried
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                failures = self.transport.send_batch(messages)
+            except Exception as e:
+                failures = [(message, e) for message in messages]
+            messages = []
+            for message, error in failures:
+                if isinstance(error, PermanentEmailError):
+                    logger.error({"message": 'mail_rejected', "recipient": message['recipient'],
+                                  "error": str(error)})
+                else:
+                    messages.append(message)
+            if not messages:
+                return
+            if attempt < self.max_retries:
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        for message in messages:
+            logger.error({"message": 'mail_failed', "recipient": message['recipient']})
+
+
+mailer = Mailer()
 
 
 def send_email(sender, recipient, subject, body):
-    # Replace 'your-region' with your AWS region
-    ses_client = session.client('ses', region_name=os.environ['AWS_REGION'])
-    email_message = {
-        'Subject': {'Data': subject},
-        'Body': {'Html': {'Data': body}},
-    }
-    try:
-        response = ses_client.send_email(
-            Source=sender,
-            Destination={'ToAddresses': [recipient]},
-            Message=email_message
-        )
-        print('response: ', response)
-    except ClientError as e:
-        print("Error sending email:", e.response['Error']['Message'])
+    return mailer.enqueue(sender, recipient, subject, body)
 
 
 def template_create(user):
@@ -33,6 +221,6 @@ def template_create(user):
                       f"""
      <h2>Bonjour {user.name},</h2><br>
     <p>Votre compte a été créée,voici le code de verification de votre compte: <b>{user.token}</b> </p>
-    Cordialement,<br> 
+    Cordialement,<br>
 """
                       )
@@ -0,0 +1,277 @@
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+# Dump of the workers that exited, see fold_worker_metrics
+EXITED_DUMP = 'metrics-exited.json'
+
+HELP = {
+    'http_request_duration_seconds': ('histogram', 'Request latency by endpoint, method and status'),
+    'db_queries_per_request': ('histogram', 'SQL statements executed per request'),
+    'db_queries_total': ('counter', 'SQL statements executed'),
+    'db_query_duration_seconds_total': ('counter', 'Time spent in SQL statements'),
+    'cache_requests_total': ('counter', 'Cache lookups by key prefix and result'),
+    'cache_local_requests_total': ('counter', 'In-process cache tier lookups by key prefix and result'),
+    'rate_limit_rejections_total': ('counter', 'Requests rejected by the rate limiter'),
+}
+
+
+class Registry:
+    """
+    Counters and histograms of one process, keyed by (name, labels)
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'buckets': list(buckets), 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), dict(histogram, counts=list(histogram['counts']))]
+                               for (name, labels), histogram in self.histograms.items()],
+            }
+
+
+def merge(snapshots):
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, histogram in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = dict(histogram, counts=list(histogram['counts']))
+                continue
+            merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+            merged['sum'] += histogram['sum']
+            merged['count'] += histogram['count']
+    return counters, histograms
+
+
+def _read_dump(path):
+    try:
+        with open(path) as dump:
+            return json.load(dump)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_dump(path, snapshot):
+    with open(path + '.tmp', 'w') as dump:
+        json.dump(snapshot, dump)
+    os.replace(path + '.tmp', path)
+
+
+def reset_metrics_dir(directory):
+    """
+    Empties the dumps directory, when the gunicorn master starts: the dumps
+    of a previous run are not part of this one
+    """
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json*')):
+        os.remove(path)
+
+
+def fold_worker_metrics(directory, pid):
+    """
+    Adds the last dump of an exited worker to the aggregate of the exited
+    ones and removes it, from the gunicorn master: the directory holds one
+    dump per live worker, and a recycled pid never overwrites counters.
+    While both files exist the aggregate lists the pid, so that collect()
+    never counts it twice.
+    """
+    path = os.path.join(directory, f'metrics-{pid}.json')
+    dump = _read_dump(path)
+    if dump is None:
+        return
+    exited = os.path.join(directory, EXITED_DUMP)
+    aggregate = _read_dump(exited) or {'counters': [], 'histograms': []}
+    counters, histograms = merge([aggregate, dump])
+    folded = {'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+              'histograms': [[name, list(labels), histogram] for (name, labels), histogram in histograms.items()]}
+    _write_dump(exited, dict(folded, folded_pids=[pid]))
+    os.remove(path)
+    _write_dump(exited, folded)
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def render(counters, histograms):
+    """
+    Prometheus text exposition format
+    """
+    lines = []
+    names = sorted({name for name, _ in counters} | {name for name, _ in histograms})
+    for name in names:
+        kind, description = HELP.get(name, ('untyped', name))
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f'{name}{_labels(labels)} {value}')
+        for (metric, labels), histogram in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                lines.append(f'{name}_bucket{_labels(labels, [("le", bound)])} {count}')
+            lines.append(f'{name}_bucket{_labels(labels, [("le", "+Inf")])} {histogram["count"]}')
+            lines.append(f'{name}_sum{_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{name}_count{_labels(labels)} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics:
+    """
+    Request, database, cache and rate limiter instrumentation exposed on
+    /metrics. With METRICS_DIR set, every worker periodically dumps its
+    registry there and /metrics sums the dumps of all workers, the exited
+    ones being folded into one aggregate by the gunicorn master
+    (fold_worker_metrics) so that counters never go backwards.
+    """
+
+    def __init__(self, app=None, cache=None, local_cache=None):
+        self.registry = Registry()
+        self.directory = None
+        self.flush_interval = 5
+        self._last_flush = 0.0
+        if app is not None:
+            self.init_app(app, cache, local_cache)
+
+    def init_app(self, app, cache=None, local_cache=None):
+        self.directory = app.config.get('METRICS_DIR')
+        self.flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', 5)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            atexit.register(self.flush)
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        # Installed once per process however many apps are built (tests,
+        # benchmarks): the engines and the cache are global
+        if (not event.contains(Engine, 'before_cursor_execute', self._before_cursor_execute)):
+            event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        if cache is not None:
+            self.instrument_cache(cache)
+        if local_cache is not None:
+            self.instrument_cache(local_cache, 'cache_local_requests_total')
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+        app.extensions['metrics'] = self
+
+    def _start_request(self):
+        g.metrics_started_at = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_db_time = 0.0
+
+    def _end_request(self, response):
+        started_at = g.pop('metrics_started_at', None)
+        if started_at is None or request.endpoint == 'metrics':
+            return response
+        endpoint = request.endpoint or 'unknown'
+        self.registry.observe('http_request_duration_seconds',
+                              {'endpoint': endpoint, 'method': request.method, 'status': response.status_code},
+                              time.perf_counter() - started_at, LATENCY_BUCKETS)
+        queries = g.pop('metrics_queries', 0)
+        self.registry.observe('db_queries_per_request', {'endpoint': endpoint},
+                              queries, QUERY_COUNT_BUCKETS)
+        self.registry.inc('db_queries_total', {'endpoint': endpoint}, queries)
+        self.registry.inc('db_query_duration_seconds_total', {'endpoint': endpoint},
+                          g.pop('metrics_db_time', 0.0))
+        if response.status_code == 429:
+            self.registry.inc('rate_limit_rejections_total', {'endpoint': endpoint})
+        if self.directory and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started_at', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_started_at'].pop()
+        if has_request_context() and 'metrics_queries' in g:
+            g.metrics_queries += 1
+            g.metrics_db_time += elapsed
+        else:
+            self.registry.inc('db_queries_total', {'endpoint': 'background'})
+            self.registry.inc('db_query_duration_seconds_total', {'endpoint': 'background'}, elapsed)
+
+    def instrument_cache(self, cache, name='cache_requests_total'):
+        """
+        Count hits and misses of cache.get, labelled with the key prefix, a
+        cache already counted by this registry is left as is
+        """
+        get = cache.get
+        registry = self.registry
+        if (getattr(get, 'metrics_registry', None) is registry):
+            return
+
+        def counting_get(key, *args, **kwargs):
+            value = get(key, *args, **kwargs)
+            registry.inc(name, {'prefix': str(key).split(':', 1)[0],
+                                'result': 'miss' if value is None else 'hit'})
+            return value
+        counting_get.metrics_registry = registry
+        cache.get = counting_get
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'metrics-{pid}.json')
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        _write_dump(self._path(os.getpid()), self.registry.snapshot())
+
+    def collect(self):
+        snapshots = [self.registry.snapshot()]
+        if self.directory:
+            skipped = {self._path(os.getpid())}
+            exited = _read_dump(os.path.join(self.directory, EXITED_DUMP))
+            if exited is not None:
+                snapshots.append(exited)
+                skipped.update(self._path(pid) for pid in exited.get('folded_pids', []))
+            for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+                if path in skipped or os.path.basename(path) == EXITED_DUMP:
+                    continue
+                dump = _read_dump(path)
+                if dump is not None:
+                    snapshots.append(dump)
+        return merge(snapshots)
+
+    def metrics_view(self):
+        return Response(render(*self.collect()), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,52 @@
+"""initial schema
+
+Tables as they were created by db.create_all() before migrations existed,
+an existing database can be marked as up to date with `flask db stamp 4f9187dd9e60`
+
+Revision ID: 4f9187dd9e60
+Revises: 
+Create Date: 2026-10-18 13:11:34.733881
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f9187dd9e60'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'user',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=100), nullable=False),
+        sa.Column('email', sa.String(length=100), nullable=False),
+        sa.Column('password', sa.String(length=255), nullable=False),
+        sa.Column('token', sa.String(length=32), nullable=False),
+        sa.Column('emailChecked', sa.Boolean(), nullable=False),
+        sa.Column('role', sa.String(length=100), nullable=False),
+        sa.Column('has_subscribed', sa.Boolean(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('token'),
+    )
+    op.create_table(
+        'todo',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(length=100), nullable=False),
+        sa.Column('description', sa.String(length=500), nullable=True),
+        sa.Column('completed', sa.Boolean(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('deadline', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade():
+    op.drop_table('todo')
+    op.drop_table('user')
@@ -0,0 +1,31 @@
+"""todo updated_at
+
+Row version used for ETags, backfilled from created_at. SQLite keeps the
+column nullable: making it NOT NULL would rebuild the table and drop the
+full-text search triggers.
+
+Revision ID: 5cffb07cc285
+Revises: 67625c30b51d
+Create Date: 2026-10-18 13:21:31.711571
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5cffb07cc285'
+down_revision = '67625c30b51d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('todo', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.execute("UPDATE todo SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP)")
+    if op.get_bind().dialect.name != 'sqlite':
+        op.alter_column('todo', 'updated_at', nullable=False)
+
+
+def downgrade():
+    op.drop_column('todo', 'updated_at')
@@ -0,0 +1,32 @@
+"""todo reminded_at watermark
+
+Todos already overdue are marked as reminded so that the first run of the
+new reminder job does not resend everything.
+
+Revision ID: 67625c30b51d
+Revises: 845ca693b21e
+Create Date: 2026-10-18 13:15:47.793602
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '67625c30b51d'
+down_revision = '845ca693b21e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('todo', sa.Column('reminded_at', sa.DateTime(), nullable=True))
+    op.execute("UPDATE todo SET reminded_at = CURRENT_TIMESTAMP WHERE deadline < CURRENT_TIMESTAMP")
+    op.create_index('ix_todo_reminder_due', 'todo', ['deadline', 'user_id'],
+                    postgresql_where=sa.text('completed = false AND reminded_at IS NULL'),
+                    sqlite_where=sa.text('completed = 0 AND reminded_at IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_todo_reminder_due', table_name='todo')
+    op.drop_column('todo', 'reminded_at')
@@ -0,0 +1,56 @@
+"""todo full text search
+
+Postgres: generated tsvector column over title/description with a GIN index.
+SQLite: external content FTS5 table kept in sync by triggers, built from the
+existing rows.
+
+Revision ID: 845ca693b21e
+Revises: 935d71ef6b9b
+Create Date: 2026-10-18 13:13:34.517605
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '845ca693b21e'
+down_revision = '935d71ef6b9b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("""ALTER TABLE todo ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(description, '')), 'B')) STORED""")
+        op.execute("CREATE INDEX ix_todo_search_vector ON todo USING gin (search_vector)")
+    elif dialect == 'sqlite':
+        op.execute("""CREATE VIRTUAL TABLE todo_fts USING fts5(
+            title, description, content='todo', content_rowid='id')""")
+        op.execute("""CREATE TRIGGER todo_fts_ai AFTER INSERT ON todo BEGIN
+            INSERT INTO todo_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+        END""")
+        op.execute("""CREATE TRIGGER todo_fts_ad AFTER DELETE ON todo BEGIN
+            INSERT INTO todo_fts(todo_fts, rowid, title, description)
+            VALUES ('delete', old.id, old.title, old.description);
+        END""")
+        op.execute("""CREATE TRIGGER todo_fts_au AFTER UPDATE OF title, description ON todo BEGIN
+            INSERT INTO todo_fts(todo_fts, rowid, title, description)
+            VALUES ('delete', old.id, old.title, old.description);
+            INSERT INTO todo_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+        END""")
+        op.execute("INSERT INTO todo_fts(todo_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("DROP INDEX ix_todo_search_vector")
+        op.execute("ALTER TABLE todo DROP COLUMN search_vector")
+    elif dialect == 'sqlite':
+        for trigger in ('todo_fts_au', 'todo_fts_ad', 'todo_fts_ai'):
+            op.execute(f"DROP TRIGGER {trigger}")
+        op.execute("DROP TABLE todo_fts")
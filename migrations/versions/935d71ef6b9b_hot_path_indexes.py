@@ -0,0 +1,38 @@
+"""hot path indexes
+
+- (user_id, completed, deadline, id) covers every per-user todo read
+- unique email/name let signup rely on constraint violations, duplicates
+  have to be cleaned up before upgrading an existing database
+- partial index on open todos by deadline for the reminder job
+
+Revision ID: 935d71ef6b9b
+Revises: 4f9187dd9e60
+Create Date: 2026-10-18 13:11:41.287966
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '935d71ef6b9b'
+down_revision = '4f9187dd9e60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_todo_user_completed_deadline', 'todo',
+                    ['user_id', 'completed', 'deadline', 'id'])
+    op.create_index('ix_todo_open_deadline', 'todo', ['deadline'],
+                    postgresql_where=sa.text('completed = false'),
+                    sqlite_where=sa.text('completed = 0'))
+    op.create_index('ix_user_email', 'user', ['email'], unique=True)
+    op.create_index('ix_user_name', 'user', ['name'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_user_name', table_name='user')
+    op.drop_index('ix_user_email', table_name='user')
+    op.drop_index('ix_todo_open_deadline', table_name='todo')
+    op.drop_index('ix_todo_user_completed_deadline', table_name='todo')
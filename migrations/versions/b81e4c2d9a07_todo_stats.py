@@ -0,0 +1,36 @@
+"""todo stats
+
+Per-user todo counters (see stats.py), backfilled from the todos.
+
+Revision ID: b81e4c2d9a07
+Revises: 5cffb07cc285
+Create Date: 2026-10-18 13:48:02.418512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b81e4c2d9a07'
+down_revision = '5cffb07cc285'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('todo_stats',
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('total', sa.Integer(), nullable=False),
+                    sa.Column('completed', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('user_id')
+                    )
+    op.execute("""INSERT INTO todo_stats (user_id, total, completed)
+        SELECT u.id, COUNT(t.id), COALESCE(SUM(CASE WHEN t.completed THEN 1 ELSE 0 END), 0)
+        FROM "user" u LEFT OUTER JOIN todo t ON t.user_id = u.id
+        GROUP BY u.id""")
+
+
+def downgrade():
+    op.drop_table('todo_stats')
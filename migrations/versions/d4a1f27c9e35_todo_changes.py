@@ -0,0 +1,56 @@
+"""todo changes
+
+Revision of every todo in its user's change feed, the users' last
+revisions and the tombstones of the deleted todos. The existing todos get
+their id as revision (unique per user), the users the largest revision of
+their todos. SQLite keeps the server defaults: dropping them would rebuild
+the table and drop the full-text search triggers.
+
+Revision ID: d4a1f27c9e35
+Revises: b81e4c2d9a07
+Create Date: 2026-10-18 14:32:07.906114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a1f27c9e35'
+down_revision = 'b81e4c2d9a07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    op.add_column('todo', sa.Column('revision', sa.BigInteger(), server_default='0', nullable=False))
+    op.execute("UPDATE todo SET revision = id")
+    op.create_index('ix_todo_user_revision', 'todo', ['user_id', 'revision', 'id'], unique=False)
+    op.add_column('todo_stats', sa.Column('revision', sa.BigInteger(), server_default='0', nullable=False))
+    op.add_column('todo_stats', sa.Column('compacted_revision', sa.BigInteger(),
+                                          server_default='0', nullable=False))
+    op.execute("""UPDATE todo_stats SET revision = COALESCE(
+        (SELECT MAX(t.revision) FROM todo t WHERE t.user_id = todo_stats.user_id), 0)""")
+    if not sqlite:
+        op.alter_column('todo', 'revision', server_default=None)
+        op.alter_column('todo_stats', 'revision', server_default=None)
+        op.alter_column('todo_stats', 'compacted_revision', server_default=None)
+    op.create_table('todo_tombstone',
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('revision', sa.BigInteger(), autoincrement=False, nullable=False),
+                    sa.Column('todo_id', sa.Integer(), autoincrement=False, nullable=False),
+                    sa.Column('deleted_at', sa.DateTime(), nullable=False),
+                    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('user_id', 'revision', 'todo_id')
+                    )
+    op.create_index(op.f('ix_todo_tombstone_deleted_at'), 'todo_tombstone', ['deleted_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_todo_tombstone_deleted_at'), table_name='todo_tombstone')
+    op.drop_table('todo_tombstone')
+    op.drop_column('todo_stats', 'compacted_revision')
+    op.drop_column('todo_stats', 'revision')
+    op.drop_index('ix_todo_user_revision', table_name='todo')
+    op.drop_column('todo', 'revision')
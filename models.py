@@ -1,6 +1,13 @@
 
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy()
+from sqlalchemy import DDL, event
+from replicas import RoutingSession
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def todo_etag(id_todo, updated_at):
+    return f"{id_todo}-{updated_at.strftime('%Y%m%d%H%M%S%f')}"
 
 
 class Todo(db.Model):
@@ -12,10 +19,36 @@ class Todo(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     deadline = db.Column(db.DateTime, nullable=True)
+    reminded_at = db.Column(db.DateTime, nullable=True)
+    # Set in Python for a microsecond resolution, it versions the row for ETags
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow, nullable=False)
+    # Position of the last write of the todo in its user's change feed
+    # (see changes.py), drawn from TodoStats.revision
+    revision = db.Column(db.BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_todo_user_completed_deadline',
+                 'user_id', 'completed', 'deadline', 'id'),
+        db.Index('ix_todo_user_revision', 'user_id', 'revision', 'id'),
+        # SQLite only uses a partial index when the query repeats its
+        # predicate verbatim, and SQLAlchemy renders `completed == False` as `= 0`
+        db.Index('ix_todo_open_deadline', 'deadline',
+                 postgresql_where=db.text('completed = false'),
+                 sqlite_where=db.text('completed = 0')),
+        db.Index('ix_todo_reminder_due', 'deadline', 'user_id',
+                 postgresql_where=db.text(
+                     'completed = false AND reminded_at IS NULL'),
+                 sqlite_where=db.text('completed = 0 AND reminded_at IS NULL')),
+    )
 
     def __repr__(self):
         return f'<Todo {self.title}>'
 
+    @property
+    def etag(self):
+        return todo_etag(self.id, self.updated_at)
+
     @property
     def serialize(self):
         return {
@@ -24,20 +57,53 @@ class Todo(db.Model):
             'description': self.description,
             'completed': self.completed,
             'user_id': self.user_id,
-            'deadline': self.deadline.strftime('%m/%d/%y %H:%M:%S')
+            'deadline': self.deadline.strftime('%m/%d/%y %H:%M:%S') if self.deadline else None
+        }
+
+
+class TodoStats(db.Model):
+    """
+    Counters of the todos of a user, kept up to date by the transactions
+    that write the todos (see stats.py)
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    completed = db.Column(db.Integer, nullable=False, default=0)
+    # Last revision given to a write of the user's todos, and the last one
+    # whose tombstones were compacted
+    revision = db.Column(db.BigInteger, nullable=False, default=0)
+    compacted_revision = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @property
+    def serialize(self):
+        return {
+            'total': self.total,
+            'completed': self.completed,
+            'open': self.total - self.completed,
         }
 
 
+class TodoTombstone(db.Model):
+    """
+    A deleted todo, kept in the change feed until compacted
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    revision = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    todo_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    email = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(100), nullable=False, unique=True, index=True)
+    email = db.Column(db.String(100), nullable=False, unique=True, index=True)
     # picture = db.Column(db.String(255), nullable=True)
     password = db.Column(db.String(255), nullable=False)
     token = db.Column(db.String(32), nullable=False, unique=True)
     emailChecked = db.Column(db.Boolean, nullable=False, default=False)
     role = db.Column(db.String(100), nullable=False)
     todos = db.relationship('Todo', backref='user')
+    todo_stats = db.relationship('TodoStats', uselist=False, backref='user')
     has_subscribed = db.Column(db.Boolean, default=False,)
 
     def __repr__(self):
@@ -53,3 +119,39 @@ class User(db.Model):
             'role': self.role,
             'todos': self.todos
         }
+
+
+# Full-text search over title/description is maintained by the database:
+# a generated tsvector column with a GIN index on Postgres, an external
+# content FTS5 table kept in sync by triggers on SQLite
+TODO_SEARCH_DDL = {
+    'postgresql': [
+        """ALTER TABLE todo ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(description, '')), 'B')) STORED""",
+        "CREATE INDEX IF NOT EXISTS ix_todo_search_vector ON todo USING gin (search_vector)",
+    ],
+    'sqlite': [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS todo_fts USING fts5(
+            title, description, content='todo', content_rowid='id')""",
+        """CREATE TRIGGER IF NOT EXISTS todo_fts_ai AFTER INSERT ON todo BEGIN
+            INSERT INTO todo_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS todo_fts_ad AFTER DELETE ON todo BEGIN
+            INSERT INTO todo_fts(todo_fts, rowid, title, description)
+            VALUES ('delete', old.id, old.title, old.description);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS todo_fts_au AFTER UPDATE OF title, description ON todo BEGIN
+            INSERT INTO todo_fts(todo_fts, rowid, title, description)
+            VALUES ('delete', old.id, old.title, old.description);
+            INSERT INTO todo_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+        END""",
+    ],
+}
+
+for dialect, statements in TODO_SEARCH_DDL.items():
+    for statement in statements:
+        event.listen(Todo.__table__, 'after_create',
+                     DDL(statement).execute_if(dialect=dialect))
+event.listen(Todo.__table__, 'before_drop',
+             DDL("DROP TABLE IF EXISTS todo_fts").execute_if(dialect='sqlite'))
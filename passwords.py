@@ -0,0 +1,105 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import threading
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords in a small process pool so that the key
+    derivation never runs on the request thread (nor holds the GIL of the
+    worker serving the other requests). At most PASSWORD_HASH_MAX_PENDING
+    computations are queued or running, beyond that HasherBusy is raised
+    instead of letting a login burst pile up behind the pool.
+    """
+
+    def __init__(self, app=None):
+        self.method = None
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.method = config.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+        self.workers = config.get('PASSWORD_HASH_WORKERS', 2)
+        self.timeout = config.get('PASSWORD_HASH_TIMEOUT', 10)
+        self._slots = threading.BoundedSemaphore(
+            config.get('PASSWORD_HASH_MAX_PENDING', 4 * self.workers))
+        app.extensions['password_hasher'] = self
+
+    @property
+    def pool(self):
+        # Created lazily in the process that hashes: a pool does not survive
+        # a gunicorn fork. forkserver children do not inherit the threads
+        # (mailer, log listener) of the app process.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver'))
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _reset_pool(self, broken):
+        # Unless another thread already replaced it
+        with self._lock:
+            if self._pool is broken:
+                broken.shutdown(wait=False)
+                self._pool, self._pid = None, None
+
+    def _submit(self, pool, function, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HasherBusy()
+        try:
+            future = pool.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the computation ends, even when the caller
+        # stops waiting for it
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HasherBusy()
+
+    def _run(self, function, *args):
+        # A pool whose child died (OOM kill, segfault) fails every later
+        # call: it is rebuilt once, then the hasher gives up for this call
+        for _ in range(2):
+            pool = self.pool
+            try:
+                return self._submit(pool, function, *args)
+            except BrokenProcessPool:
+                self._reset_pool(pool)
+        raise HasherBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """
+        Whether a stored hash was made with another method or cost than the
+        configured one
+        """
+        return pwhash.split('$', 1)[0] != self.method
+
+    def shutdown(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown(wait=True)
+            self._pid = None
+
+
+password_hasher = PasswordHasher()
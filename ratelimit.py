@@ -0,0 +1,148 @@
+from contextlib import contextmanager
+import os
+import random
+import sqlite3
+import threading
+import time
+from flask_jwt_extended import verify_jwt_in_request
+from flask_limiter.util import get_remote_address
+from limits.storage import MovingWindowSupport, Storage
+from utils import current_user_id
+
+
+def rate_limit_key():
+    """
+    Authenticated requests are limited per user (whatever address they come
+    from), the others per remote address
+    """
+    try:
+        if verify_jwt_in_request(optional=True) is not None:
+            user_id = current_user_id()
+            if user_id is not None:
+                return f'user:{user_id}'
+    except Exception:
+        pass
+    return f'ip:{get_remote_address()}'
+
+
+class SQLiteStorage(Storage, MovingWindowSupport):
+    """
+    limits storage in a local SQLite file shared by every worker of a host,
+    for deployments without Redis: `sqlite:///ratelimit.db` (relative) or
+    `sqlite:////var/run/api/ratelimit.db`. Each check is one IMMEDIATE
+    transaction, so concurrent workers never both take the last entry of a
+    window.
+    """
+
+    STORAGE_SCHEME = ['sqlite']
+    # Fraction of writes that also purge the expired rows of every key
+    PURGE_PROBABILITY = 0.01
+
+    def __init__(self, uri, **options):
+        super().__init__(uri, **options)
+        self.path = uri[len('sqlite:///'):] or ':memory:'
+        self.timeout = float(options.get('timeout', 5))
+        self._local = threading.local()
+        with self._transaction() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS ratelimit_counter '
+                               '(key TEXT PRIMARY KEY, count INTEGER NOT NULL, expires_at REAL NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS ratelimit_entry '
+                               '(key TEXT NOT NULL, acquired_at REAL NOT NULL, expires_at REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_ratelimit_entry_key '
+                               'ON ratelimit_entry (key, acquired_at)')
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    @property
+    def connection(self):
+        # One connection per thread and per process: sqlite connections
+        # survive neither a fork nor sharing between threads
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return self._local.connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _purge(self, connection, now):
+        if random.random() < self.PURGE_PROBABILITY:
+            connection.execute('DELETE FROM ratelimit_counter WHERE expires_at <= ?', (now,))
+            connection.execute('DELETE FROM ratelimit_entry WHERE expires_at <= ?', (now,))
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        now = time.time()
+        with self._transaction() as connection:
+            self._purge(connection, now)
+            row = connection.execute('SELECT count, expires_at FROM ratelimit_counter WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is None or row[1] <= now:
+                count, expires_at = amount, now + expiry
+            else:
+                count, expires_at = row[0] + amount, now + expiry if elastic_expiry else row[1]
+            connection.execute('INSERT OR REPLACE INTO ratelimit_counter (key, count, expires_at) '
+                               'VALUES (?, ?, ?)', (key, count, expires_at))
+        return count
+
+    def get(self, key):
+        row = self.connection.execute('SELECT count FROM ratelimit_counter WHERE key = ? AND expires_at > ?',
+                                      (key, time.time())).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        row = self.connection.execute('SELECT expires_at FROM ratelimit_counter WHERE key = ?',
+                                      (key,)).fetchone()
+        return int(row[0]) if row else int(time.time())
+
+    def acquire_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        with self._transaction() as connection:
+            self._purge(connection, now)
+            connection.execute('DELETE FROM ratelimit_entry WHERE key = ? AND acquired_at < ?',
+                               (key, now - expiry))
+            acquired = connection.execute('SELECT COUNT(*) FROM ratelimit_entry WHERE key = ?',
+                                          (key,)).fetchone()[0]
+            if acquired + amount > limit:
+                return False
+            connection.executemany('INSERT INTO ratelimit_entry (key, acquired_at, expires_at) VALUES (?, ?, ?)',
+                                   [(key, now, now + expiry)] * amount)
+        return True
+
+    def get_moving_window(self, key, limit, expiry):
+        now = time.time()
+        start, acquired = self.connection.execute(
+            'SELECT MIN(acquired_at), COUNT(*) FROM ratelimit_entry WHERE key = ? AND acquired_at >= ?',
+            (key, now - expiry)).fetchone()
+        return int(start if start is not None else now), acquired
+
+    def check(self):
+        try:
+            self.connection.execute('SELECT 1')
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        with self._transaction() as connection:
+            cleared = connection.execute('DELETE FROM ratelimit_counter').rowcount
+            cleared += connection.execute('DELETE FROM ratelimit_entry').rowcount
+        return cleared
+
+    def clear(self, key):
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM ratelimit_counter WHERE key = ?', (key,))
+            connection.execute('DELETE FROM ratelimit_entry WHERE key = ?', (key,))
@@ -0,0 +1,66 @@
+from collections import defaultdict
+from datetime import datetime
+import os
+from flask import current_app
+from sqlalchemy import select, update
+from mailing import send_email
+from models import Todo, User, db
+
+
+def reminder_email(name, titles):
+    return f"""
+                <h2>Bonjour {name},</h2><br>
+                <p>Vous avez des tâches à faire dans moins d'une heure</p>
+                <ul>
+                    {"".join([f"<li>{title}</li>" for title in titles])}
+                </ul>
+                        """
+
+
+def due_window(now):
+    """
+    Open todos never reminded whose deadline enters the reminder window,
+    served by the ix_todo_reminder_due partial index
+    """
+    return (Todo.completed == False, Todo.reminded_at.is_(None),
+            Todo.deadline >= now - current_app.config['REMINDER_LOOKBACK'],
+            Todo.deadline < now + current_app.config['REMINDER_LEAD'])
+
+
+def send_reminders(now=None):
+    """
+    Send one email per subscribed user listing their newly due todos.
+
+    Users are walked by id in batches; the todos of a batch are claimed
+    (reminded_at set) in the same statement that reads them, so a todo is
+    never reminded twice even with concurrent runs, and a run that stops
+    midway leaves the remaining todos due for the next one.
+    """
+    now = now or datetime.utcnow()
+    batch_size = current_app.config['REMINDER_BATCH_SIZE']
+    window = due_window(now)
+    last_user_id = 0
+    sent = 0
+    while True:
+        user_ids = db.session.scalars(
+            select(Todo.user_id).join(User, User.id == Todo.user_id)
+            .where(*window, User.has_subscribed == True, Todo.user_id > last_user_id)
+            .group_by(Todo.user_id).order_by(Todo.user_id).limit(batch_size)).all()
+        if not user_ids:
+            return sent
+        last_user_id = user_ids[-1]
+        claimed = db.session.execute(
+            update(Todo).where(*window, Todo.user_id.in_(user_ids)).values(reminded_at=now)
+            .returning(Todo.user_id, Todo.title).execution_options(synchronize_session=False)).all()
+        users = db.session.execute(select(User.id, User.name, User.email).where(
+            User.id.in_(user_ids))).all()
+        db.session.commit()
+
+        titles = defaultdict(list)
+        for user_id, title in claimed:
+            titles[user_id].append(title)
+        for user_id, name, email in users:
+            if titles[user_id]:
+                send_email(os.environ['AWS_MAIL_SENDER'], email, "Rappel tache à faire",
+                           reminder_email(name, titles[user_id]))
+                sent += 1
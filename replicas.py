@@ -0,0 +1,183 @@
+import itertools
+import logging
+import threading
+import time
+from flask import g, has_request_context, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+class RoutingSession(Session):
+    """
+    db.session routing the plain SELECTs of a read request to the replica
+    chosen for it (g.db_replica). Flushes, INSERT/UPDATE/DELETE, SELECT ...
+    FOR UPDATE and everything outside of a request go to the primary, and so
+    do the reads of a request after its first write or after its replica
+    failed (the failed read is run again on the primary).
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and has_request_context()):
+            if (self._flushing or getattr(clause, 'is_dml', False)):
+                g.db_wrote = True
+            elif (g.get('db_replica') is not None and not g.get('db_wrote')
+                    and getattr(clause, 'is_select', False)
+                    and getattr(clause, '_for_update_arg', None) is None):
+                return g.db_replica.engine
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+    def _failover(self, method, *args, **kwargs):
+        """
+        Runs a read again on the primary when the request's replica just
+        failed it, the replica being left out of the rotation meanwhile
+        """
+        try:
+            return method(*args, **kwargs)
+        except DBAPIError:
+            if (not has_request_context() or not g.pop('db_replica_failed', False)):
+                raise
+            self.rollback()
+            g.db_replica = None
+            return method(*args, **kwargs)
+
+    def execute(self, *args, **kwargs):
+        return self._failover(super().execute, *args, **kwargs)
+
+    def scalar(self, *args, **kwargs):
+        return self._failover(super().scalar, *args, **kwargs)
+
+    def scalars(self, *args, **kwargs):
+        return self._failover(super().scalars, *args, **kwargs)
+
+
+class Replica:
+    def __init__(self, name, engine):
+        self.name = name
+        self.engine = engine
+        # Left out of the rotation until then after a connection error
+        self.down_until = 0
+
+    def __repr__(self):
+        return f'<Replica {self.name}>'
+
+
+class ReadReplicas:
+    """
+    Read/write splitting over the SQLALCHEMY_BINDS named replica*: every GET
+    request reads from the next healthy replica (round-robin), unless its
+    user wrote less than DB_REPLICA_STICKINESS seconds ago, so that users
+    read their own writes despite the replication lag. Until
+    DB_REPLICA_LAG_WINDOW after the write, the responses read from a replica
+    are cached no longer than the stickiness (g.cache_timeout_cap). Without
+    replicas everything goes to the primary.
+    """
+
+    def __init__(self):
+        self.replicas = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def init_app(self, app, db, cache):
+        self.cache = cache
+        self.stickiness = app.config.get('DB_REPLICA_STICKINESS', 5)
+        self.lag_window = app.config.get('DB_REPLICA_LAG_WINDOW', 60)
+        self.retry_interval = app.config.get('DB_REPLICA_RETRY_INTERVAL', 30)
+        with app.app_context():
+            self.replicas = [Replica(name, engine) for name, engine in db.engines.items()
+                             if name is not None and name.startswith('replica')]
+        for replica in self.replicas:
+            event.listen(replica.engine, 'handle_error', self._handle_error(replica))
+        app.before_request(self._route_request)
+        app.after_request(self._stick_writer)
+        app.teardown_request(self._end_request)
+
+    def _handle_error(self, replica):
+        def handle_error(context):
+            # Lost or refused connections only: a failed statement (e.g. a
+            # statement timeout) says nothing about the replica's health
+            if (context.is_disconnect or context.connection is None):
+                self.mark_down(replica, context.original_exception)
+                if (has_request_context()):
+                    g.db_replica_failed = True
+        return handle_error
+
+    def mark_down(self, replica, error):
+        replica.down_until = time.monotonic() + self.retry_interval
+        logger.warning({"message": 'replica_down', "replica": replica.name, "error": str(error)})
+
+    def _healthy(self, replica):
+        """
+        False while a failed replica waits for its retry, which then has to
+        answer a SELECT 1 to come back in the rotation
+        """
+        if (replica.down_until == 0):
+            return True
+        if (replica.down_until > time.monotonic()):
+            return False
+        try:
+            with replica.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except Exception as e:
+            self.mark_down(replica, e)
+            return False
+        replica.down_until = 0
+        return True
+
+    def choose(self):
+        """
+        Next healthy replica, None when all of them are down
+        """
+        with self._lock:
+            start = next(self._counter)
+        for index in range(len(self.replicas)):
+            replica = self.replicas[(start + index) % len(self.replicas)]
+            if (self._healthy(replica)):
+                return replica
+        return None
+
+    def _sticky_key(self):
+        """
+        Cache key of the authenticated user's stickiness, None for anonymous
+        requests
+        """
+        try:
+            if (verify_jwt_in_request(optional=True) is not None):
+                return f'db_primary:{get_jwt_identity()}'
+        except Exception:
+            pass
+        return None
+
+    def _route_request(self):
+        self._end_request()
+        if (not self.replicas or request.method not in READ_METHODS):
+            return
+        key = self._sticky_key()
+        written_at = self.cache.get(key) if key is not None else None
+        if (written_at is not None and time.time() - written_at < self.stickiness):
+            return
+        g.db_replica = self.choose()
+        if (g.db_replica is not None and written_at is not None):
+            # The replica may still lag the user's write: what is rendered
+            # from it must not stay cached under the user's new generation
+            g.cache_timeout_cap = self.stickiness
+
+    def _stick_writer(self, response):
+        if (g.get('db_wrote') and self.replicas):
+            key = self._sticky_key()
+            if (key is not None):
+                self.cache.set(key, time.time(), timeout=max(self.stickiness, self.lag_window))
+        return response
+
+    def _end_request(self, exception=None):
+        # Request state, not left over in an outer application context
+        g.db_replica, g.db_wrote, g.db_replica_failed = None, False, False
+        g.cache_timeout_cap = None
+
+
+read_replicas = ReadReplicas()
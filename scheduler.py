@@ -0,0 +1,51 @@
+"""
+Background jobs of the API, run as their own process next to the web
+workers (one is enough, concurrent runs never remind a todo twice):
+
+    python scheduler.py
+"""
+from datetime import datetime
+import logging
+from apscheduler.schedulers.blocking import BlockingScheduler
+from dotenv import load_dotenv
+from flask_apscheduler import APScheduler
+from app import create_app
+from changes import compact_tombstones
+from models import db
+from reminders import send_reminders
+
+logger = logging.getLogger(__name__)
+scheduler = APScheduler(BlockingScheduler())
+
+
+@scheduler.task('interval', id='send_remainder_todo', seconds=3600, max_instances=1, coalesce=True)
+def send_remainder_todo():
+    logger.info({"message": 'send_remainder_todo'})
+    with scheduler.app.app_context():
+        try:
+            sent = send_reminders()
+            logger.info({"message": 'send_remainder_todo', "sent": sent})
+        except BaseException as e:
+            db.session.rollback()
+            logger.error({"message": 'send_remainder_todo', "error": str(e)})
+
+
+@scheduler.task('interval', id='compact_tombstones', hours=24, max_instances=1, coalesce=True)
+def compact_deleted_todos():
+    with scheduler.app.app_context():
+        try:
+            removed = compact_tombstones(datetime.utcnow() - scheduler.app.config['TOMBSTONE_RETENTION'])
+            logger.info({"message": 'compact_tombstones', "removed": removed})
+        except BaseException as e:
+            db.session.rollback()
+            logger.error({"message": 'compact_tombstones', "error": str(e)})
+
+
+def main():
+    load_dotenv()
+    scheduler.init_app(create_app())
+    scheduler.start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+from datetime import datetime
+from functools import wraps
+import re
+from flask import current_app, g, request
+from werkzeug.exceptions import RequestEntityTooLarge
+from utils import DEADLINE_FORMAT
+
+
+class SchemaError(Exception):
+    def __init__(self, message, field=None):
+        super().__init__(message)
+        self.message = message
+        self.field = field
+
+    @property
+    def response(self):
+        return {'message': self.message, 'status': 'FAILED', 'requestStatus': False}
+
+
+class Field:
+    """
+    A typed body field: `kind` is checked with `type(value) is kind` (so
+    that True is not an int), `coerce` then turns the value into what the
+    handler uses
+    """
+
+    def __init__(self, kind, required=True, max_length=None, coerce=None):
+        self.kind = kind
+        self.required = required
+        self.max_length = max_length
+        self.coerce = coerce
+
+    def optional(self):
+        return type(self)(**dict(vars(self), required=False))
+
+    def compile(self, name):
+        """
+        Specialised `value -> coerced value` function, raising SchemaError
+        """
+        kind, max_length, coerce = self.kind, self.max_length, self.coerce
+        type_error = f"Champ {name} doit être de type {kind}"
+        length_error = f"Champ {name} doit faire au plus {max_length} caractères"
+
+        def check(value):
+            if (type(value) is not kind):
+                raise SchemaError(type_error, name)
+            if (max_length is not None and len(value) > max_length):
+                raise SchemaError(length_error, name)
+            return value if coerce is None else coerce(name, value)
+        return check
+
+
+def String(max_length=None, required=True):
+    return Field(str, required, max_length)
+
+
+def Boolean(required=True):
+    return Field(bool, required)
+
+
+def Integer(required=True):
+    return Field(int, required)
+
+
+# DEADLINE_FORMAT, matched without strptime (which costs more than the rest
+# of the validation of a todo)
+DEADLINE_PATTERN = re.compile(r'(\d\d?)/(\d\d?)/(\d\d) (\d\d?):(\d\d?):(\d\d?)\Z')
+
+
+def _parse_deadline(name, value):
+    try:
+        match = DEADLINE_PATTERN.match(value)
+        if (match is None):
+            return datetime.strptime(value, DEADLINE_FORMAT)
+        month, day, year, hour, minute, second = map(int, match.groups())
+        # %y: 69-99 are 19xx, 00-68 20xx
+        return datetime(year + (1900 if year >= 69 else 2000), month, day, hour, minute, second)
+    except ValueError:
+        raise SchemaError(f"Champ {name} doit respecter le format {DEADLINE_FORMAT}", name)
+
+
+def Deadline(required=True):
+    return Field(str, required, 32, _parse_deadline)
+
+
+def List(item=None, required=True, min_length=1):
+    """
+    A JSON array, each element checked against the `item` field
+    """
+    def coerce(name, values):
+        if (len(values) < min_length):
+            raise SchemaError(f"Champ {name} requis", name)
+        if (item is None):
+            return values
+        check = Field(item.kind, max_length=item.max_length, coerce=item.coerce).compile(name)
+        try:
+            return [check(value) for value in values]
+        except SchemaError:
+            raise SchemaError(f"Champ {name} doit être de type {[item.kind]}", name)
+    return Field(list, required, coerce=coerce)
+
+
+class Schema:
+    """
+    Validator of a JSON object body, compiled once: every field gets its own
+    check function and a body is walked in a single pass, rejecting unknown
+    fields and returning the coerced values (e.g. deadline as a datetime)
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self._checks = {name: field.compile(name) for name, field in fields.items()}
+        self._required = frozenset(name for name, field in fields.items() if field.required)
+
+    def partial(self, **fields):
+        """
+        Same fields, all optional (for PATCH), plus required `fields`
+        """
+        return Schema(dict({name: field.optional() for name, field in self.fields.items()}, **fields))
+
+    def validate(self, data):
+        if (not isinstance(data, dict) or not data):
+            raise SchemaError("Empty body")
+        checks = self._checks
+        values = {}
+        for name, value in data.items():
+            check = checks.get(name)
+            if (check is None):
+                raise SchemaError(f"Champ {name} inconnu", name)
+            values[name] = check(value)
+        if (len(values) < len(self._required) or not self._required.issubset(values)):
+            missing = sorted(self._required.difference(values))[0]
+            raise SchemaError(f"Champ {missing} requis", missing)
+        return values
+
+    def validate_many(self, items):
+        """
+        Validates every item of a batch, returns the coerced rows and the
+        errors of the invalid items (with their index)
+        """
+        rows, errors = [], []
+        for index, item in enumerate(items):
+            try:
+                if (not isinstance(item, dict)):
+                    raise SchemaError("Item invalide")
+                rows.append(self.validate(item))
+            except SchemaError as e:
+                errors.append(dict(e.response, index=index))
+        return rows, errors
+
+
+def validate_body(schema):
+    """
+    Rejects a body over MAX_CONTENT_LENGTH before reading it (413), an
+    invalid one with a 400, and exposes the validated values as `g.body`
+    """
+    def _validate_body(f):
+        @wraps(f)
+        def __validate_body(*args, **kwargs):
+            max_length = current_app.config.get('MAX_CONTENT_LENGTH')
+            too_large = ({'message': "Body trop volumineux", 'status': 'FAILED', 'requestStatus': False}, 413)
+            if (max_length is not None and (request.content_length or 0) > max_length):
+                return too_large
+            try:
+                g.body = schema.validate(request.get_json(silent=True))
+            except RequestEntityTooLarge:
+                return too_large
+            except SchemaError as e:
+                return e.response, 400
+            return f(*args, **kwargs)
+        return __validate_body
+    return _validate_body
+
+
+LOGIN_SCHEMA = Schema({'email': String(100), 'password': String(1024)})
+SIGNUP_SCHEMA = Schema({'name': String(100), 'email': String(100), 'password': String(1024)})
+CHECK_ACCOUNT_SCHEMA = Schema({'token': String(32)})
+TODO_SCHEMA = Schema({'title': String(100), 'description': String(500),
+                      'completed': Boolean(), 'deadline': Deadline()})
+TODO_PATCH_SCHEMA = TODO_SCHEMA.partial(id=Integer())
+BATCH_ITEMS_SCHEMA = Schema({'items': List()})
+BATCH_IDS_SCHEMA = Schema({'ids': List(Integer())})
@@ -0,0 +1,54 @@
+import json
+from flask import current_app
+from models import Todo
+from utils import DEADLINE_FORMAT
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Columns of Todo.serialize, selected as plain row tuples
+TODO_COLUMNS = (Todo.id, Todo.title, Todo.description,
+                Todo.completed, Todo.user_id, Todo.deadline)
+
+
+def serialize_rows(rows):
+    """
+    Todo.serialize for row tuples starting with TODO_COLUMNS, each distinct
+    deadline is formatted once per batch
+    """
+    formatted = {None: None}
+    data = []
+    for id_todo, title, description, completed, user_id, deadline, *_ in rows:
+        deadline_text = formatted.get(deadline)
+        if deadline_text is None and deadline is not None:
+            deadline_text = formatted[deadline] = deadline.strftime(DEADLINE_FORMAT)
+        data.append({'id': id_todo, 'title': title, 'description': description,
+                     'completed': completed, 'user_id': user_id, 'deadline': deadline_text})
+    return data
+
+
+def dumps(payload):
+    """
+    The bytes jsonify produces out of debug mode (sorted keys, compact, ASCII
+    only), with orjson when it is installed. Only meant for payloads made of
+    str/int/bool/None, orjson formats floats differently.
+    """
+    if orjson is not None:
+        try:
+            body = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            body = None
+        # orjson never escapes non-ASCII characters, json.dumps does
+        if body is not None and body.isascii():
+            return body + b'\n'
+    return (json.dumps(payload, ensure_ascii=True, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def json_response(payload, status=200):
+    if current_app.debug:
+        response = current_app.json.response(payload)
+        response.status_code = status
+        return response
+    return current_app.response_class(dumps(payload), status=status, mimetype='application/json')
@@ -1,6 +1,8 @@
 
 if [ $DEBUG = "True" ]; then
+    flask --app app db upgrade
     python3 app.py
 else
-    gunicorn -w 1 -b 0.0.0.0:5000 app:app
+    flask --app app db upgrade
+    gunicorn -c gunicorn.conf.py 'app:create_app()'
 fi
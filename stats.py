@@ -0,0 +1,129 @@
+from datetime import datetime
+from sqlalchemy import case, func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from models import Todo, TodoStats, User, db
+
+
+def counted_todos(user_ids=None):
+    """
+    SELECT user_id, total, completed, revision computed from the todos, for
+    every user or only for user_ids
+    """
+    query = select(User.id, func.count(Todo.id),
+                   func.coalesce(func.sum(case((Todo.completed, 1), else_=0)), 0),
+                   func.coalesce(func.max(Todo.revision), 0)
+                   ).outerjoin(Todo, Todo.user_id == User.id).group_by(User.id)
+    if user_ids is not None:
+        query = query.where(User.id.in_(user_ids))
+    return query
+
+
+def _insert_counted(user_ids):
+    """
+    Creates the missing counters of user_ids from their todos, a concurrent
+    transaction creating the same counters wins
+    """
+    dialect = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    db.session.execute(insert(TodoStats).from_select(
+        ['user_id', 'total', 'completed', 'revision'], counted_todos(user_ids)).on_conflict_do_nothing())
+
+
+def adjust_todo_stats(user_id, total=0, completed=0):
+    """
+    Applies a change of the user's todos to their counters, in the
+    transaction of the change: call it after the write, before the commit
+    """
+    if (not total and not completed):
+        return
+    db.session.flush()
+    result = db.session.execute(update(TodoStats).where(TodoStats.user_id == user_id).values(
+        total=TodoStats.total + total, completed=TodoStats.completed + completed))
+    if (result.rowcount == 0):
+        # No counters yet (user created outside the API): counted from the
+        # todos, which already include this change
+        _insert_counted([user_id])
+
+
+def next_revision(user_id, count=1):
+    """
+    Reserves `count` revisions of the user's change feed and returns the
+    first one. Call it before writing the todos: the counters stay locked
+    until the commit, so the revisions of a user are committed in order.
+    """
+    query = update(TodoStats).where(TodoStats.user_id == user_id).values(
+        revision=TodoStats.revision + count).returning(TodoStats.revision)
+    revision = db.session.scalar(query)
+    if (revision is None):
+        _insert_counted([user_id])
+        revision = db.session.scalar(query)
+    return revision - count + 1
+
+
+def stored_todo_stats(user_id):
+    """
+    The user's counters. Read-only: the counters missing (user created
+    outside the API) are counted from the todos without being stored, the
+    first write of the user or reconcile_todo_stats creates them.
+    """
+    stats = db.session.get(TodoStats, user_id)
+    if (stats is None):
+        counted = db.session.execute(counted_todos([user_id])).first()
+        if (counted is not None):
+            # Transient, never added to the session
+            stats = TodoStats(user_id=user_id, total=counted[1], completed=counted[2])
+    return stats
+
+
+def todo_stats(user_id):
+    """
+    The user's counters plus their overdue todos. Overdue depends on the
+    clock so it is not maintained, it is counted on the
+    (user_id, completed, deadline) index.
+    """
+    stats = stored_todo_stats(user_id)
+    data = stats.serialize if stats else {'total': 0, 'completed': 0, 'open': 0}
+    data['overdue'] = db.session.scalar(select(func.count()).select_from(Todo).where(
+        Todo.user_id == user_id, Todo.completed == False, Todo.deadline < datetime.utcnow()))
+    return data
+
+
+def todo_total(user_id, completed=None):
+    """
+    Number of todos of the user, or of their completed/open todos
+    """
+    stats = stored_todo_stats(user_id)
+    if (stats is None):
+        return 0
+    if (completed is None):
+        return stats.total
+    return stats.completed if completed else stats.total - stats.completed
+
+
+def reconcile_todo_stats(user_ids=None):
+    """
+    Recounts the counters from the todos and repairs the ones that drifted
+    (or are missing), returns {user_id: (stored, counted)} of the repairs.
+    A drifted counter is locked before being recounted: a concurrent write
+    either committed before the recount or applies its change after it.
+    """
+    counted = {user_id: (total, completed) for user_id, total, completed, _ in
+               db.session.execute(counted_todos(user_ids))}
+    query = select(TodoStats.user_id, TodoStats.total, TodoStats.completed)
+    if user_ids is not None:
+        query = query.where(TodoStats.user_id.in_(user_ids))
+    stored = {user_id: (total, completed) for user_id, total, completed in db.session.execute(query)}
+    db.session.rollback()
+    repairs = {}
+    for user_id in [user_id for user_id, counts in counted.items() if stored.get(user_id) != counts]:
+        stats = db.session.scalars(select(TodoStats).where(
+            TodoStats.user_id == user_id).with_for_update()).first()
+        _, total, completed, _ = db.session.execute(counted_todos([user_id])).one()
+        if (stats is None):
+            _insert_counted([user_id])
+            repairs[user_id] = (None, (total, completed))
+        elif ((stats.total, stats.completed) != (total, completed)):
+            repairs[user_id] = ((stats.total, stats.completed), (total, completed))
+            stats.total, stats.completed = total, completed
+        db.session.commit()
+    return repairs
@@ -1,18 +1,45 @@
 from werkzeug.security import generate_password_hash
-from models import User, Todo
-from datetime import datetime
+import brotli
+import gzip
+import json
+import logging
+from logging.handlers import BufferingHandler
+from models import User, Todo, TodoStats, db
+from datetime import datetime, timedelta
 import os
+import queue
 from secrets import token_hex
+import signal
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 from flask_jwt_extended import create_access_token, get_csrf_token
+from flask import g
 from flask_testing import TestCase
+from sqlalchemy import create_engine, event, text
 from dotenv import load_dotenv
 from faker import Faker
 load_dotenv()
 os.environ['APP_SETTINGS'] = 'config.TestingConfig'
-from app import app, db
+from app import create_app
+from caching import LayeredCache, LocalBus, LocalCache, cache, layered_cache
+from logs import LazyHandler, NonBlockingQueueHandler, RouteFilter
+from mailing import mailer
+from metrics import Metrics, fold_worker_metrics, reset_metrics_dir
+from passwords import password_hasher
+from ratelimit import SQLiteStorage, rate_limit_key
+from replicas import Replica, read_replicas
+from limits import parse
+from limits.strategies import MovingWindowRateLimiter
+from reminders import send_reminders
+from stats import reconcile_todo_stats
+from changes import compact_tombstones
+from utils import identity_cache, identity_claims
 
 fake = Faker()
+app = create_app()
 
 
 class TestApp(TestCase):
@@ -40,6 +67,9 @@ class TestApp(TestCase):
         """
         db.session.remove()
         db.drop_all()
+        layered_cache.clear()
+        identity_cache.invalidate()
+        mailer.transport.outbox.clear()
 
     def test_hello_route(self):
         """
@@ -61,6 +91,27 @@ class TestApp(TestCase):
         self.assertEqual(response.status_code, 201)
         self.assertTrue('requestStatus' in response.json)
         self.assertTrue(response.json['requestStatus'])
+        mailer.join()
+        self.assertEqual(mailer.transport.outbox[-1]['recipient'], 'test@example.com')
+
+    def test_signup_duplicate_route(self):
+        """
+        Should return status code 400 when the email or the name is already taken
+        """
+        response = self.client.post(
+            '/api/v1/users',
+            json={'name': 'testuser', 'email': self.user.email,
+                  'password': 'password123'}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['message'], 'Email deja pris')
+        response = self.client.post(
+            '/api/v1/users',
+            json={'name': self.user.name, 'email': 'test@example.com',
+                  'password': 'password123'}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['message'], 'Pseudo deja pris')
 
     def test_login_route(self):
         """
@@ -75,6 +126,98 @@ class TestApp(TestCase):
         self.assertTrue(response.json['requestStatus'])
         self.assertEqual(response.json['message'], "Connexion réussie")
 
+    def test_login_rehashes_password(self):
+        """
+        Should upgrade a hash made with another cost on a successful login only
+        """
+        old_hash = self.user.password
+        self.assertTrue(password_hasher.needs_rehash(old_hash))
+        response = self.client.post(
+            '/api/v1/login', json={'email': self.user.email, 'password': "wrong"})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(db.session.get(User, self.user.id).password, old_hash)
+
+        response = self.client.post(
+            '/api/v1/login', json={'email': self.user.email, 'password': "@password1234"})
+        self.assertEqual(response.status_code, 200)
+        db.session.expire_all()
+        new_hash = db.session.get(User, self.user.id).password
+        self.assertFalse(password_hasher.needs_rehash(new_hash))
+        self.assertTrue(new_hash.startswith(app.config['PASSWORD_HASH_METHOD'] + '$'))
+        response = self.client.post(
+            '/api/v1/login', json={'email': self.user.email, 'password': "@password1234"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_password_hasher_broken_pool(self):
+        """
+        Should rebuild the hashing pool after one of its processes died
+        """
+        pwhash = password_hasher.hash('@password1234')
+        pool = password_hasher.pool
+        for process in list(pool._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+        self.assertTrue(password_hasher.check(pwhash, '@password1234'))
+        self.assertIsNot(password_hasher.pool, pool)
+
+    def test_rate_limit_key(self):
+        """
+        Should limit authenticated requests per user and the others per address
+        """
+        access_token = create_access_token(identity=self.user.email,
+                                           additional_claims=identity_claims(self.user))
+        with app.test_request_context('/api/v1/todos', environ_base={'REMOTE_ADDR': '10.0.0.1'},
+                                      headers={'Cookie': f'access_token_cookie={access_token}'}):
+            self.assertEqual(rate_limit_key(), f'user:{self.user.id}')
+        with app.test_request_context('/api/v1/todos', environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            self.assertEqual(rate_limit_key(), 'ip:10.0.0.1')
+
+    def test_identity_cache(self):
+        """
+        Should keep at most IDENTITY_CACHE_MAX_ENTRIES identities, the least
+        recently used and the expired ones evicted first
+        """
+        app.config['IDENTITY_CACHE_MAX_ENTRIES'] = 2
+        try:
+            identity_cache.set('a', self.user)
+            identity_cache.set('b', self.user)
+            identity_cache.get('a')
+            identity_cache.set('c', self.user)
+            self.assertEqual(list(identity_cache._entries), ['a', 'c'])
+            app.config['IDENTITY_CACHE_TTL'] = -1
+            identity_cache.set('d', self.user)
+            self.assertEqual(list(identity_cache._entries), ['c', 'd'])
+            self.assertIsNone(identity_cache.get('d'))
+            identity_cache.set('e', self.user)
+            app.config['IDENTITY_CACHE_TTL'] = 300
+            identity_cache.set('f', self.user)
+            self.assertEqual(list(identity_cache._entries), ['f'])
+        finally:
+            app.config['IDENTITY_CACHE_MAX_ENTRIES'] = 10000
+            app.config['IDENTITY_CACHE_TTL'] = 300
+
+    def test_sqlite_rate_limit_storage(self):
+        """
+        Should share moving window counters between storages of the same file
+        """
+        path = 'test_ratelimit.db'
+        try:
+            first = MovingWindowRateLimiter(SQLiteStorage(f'sqlite:///{path}'))
+            second = MovingWindowRateLimiter(SQLiteStorage(f'sqlite:///{path}'))
+            limit = parse('3/hour')
+            self.assertTrue(first.hit(limit, 'user:1'))
+            self.assertTrue(second.hit(limit, 'user:1'))
+            self.assertTrue(first.hit(limit, 'user:1'))
+            self.assertFalse(second.hit(limit, 'user:1'))
+            self.assertTrue(second.hit(limit, 'user:2'))
+            self.assertEqual(first.get_window_stats(limit, 'user:1')[1], 0)
+            first.clear(limit, 'user:1')
+            self.assertTrue(second.hit(limit, 'user:1'))
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
     def test_add_todo_route(self):
         """
         Should return status code 201,message TodoCreated and data of the todo created
@@ -114,6 +257,109 @@ class TestApp(TestCase):
         self.assertEqual(len(response.json['data']), 3)
         self.assertEqual(response.json['data'][0]['title'], 'Test Todo 0')
 
+    def test_get_todos_serialization(self):
+        """
+        Should answer byte for byte what jsonify of Todo.serialize gives, NULL deadlines included
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        for i in range(3):
+            db.session.add(Todo(title=f'Tâche {i}', description='Testing', completed=bool(i % 2),
+                                deadline=datetime(2024, 1, 5) if i else None, user_id=self.user.id))
+        db.session.commit()
+        todos = [todo.serialize for todo in Todo.query.order_by(Todo.id)]
+        expected = app.json.response({"requestStatus": True, "count": 3, "data": todos,
+                                      "total": 3, "current_page": 1}).data
+        response = self.client.get('/api/v1/todos', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, expected)
+        response = self.client.get('/api/v1/todos', headers=headers)
+        self.assertEqual(response.data, expected)
+
+    def test_get_todos_cursor_route(self):
+        """
+        Should walk all todos of the user with next_cursor and status code 200
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        for i in range(5):
+            todo = Todo(title=f'Test Todo {i}', description='Testing', completed=False, deadline=datetime(
+                2024, 1, 5 - i % 2), user_id=self.user.id)
+            db.session.add(todo)
+        db.session.commit()
+        titles = []
+        url = '/api/v1/todos?sort=deadline&limit=2'
+        while url:
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(response.json['count'], 2)
+            titles += [todo['title'] for todo in response.json['data']]
+            next_cursor = response.json['next_cursor']
+            url = f'/api/v1/todos?sort=deadline&limit=2&after={next_cursor}' if next_cursor else None
+        self.assertEqual(titles, ['Test Todo 1', 'Test Todo 3',
+                         'Test Todo 0', 'Test Todo 2', 'Test Todo 4'])
+        response = self.client.get(
+            '/api/v1/todos?limit=2&after=notacursor', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_todos_search_route(self):
+        """
+        Should only return the todos matching the full-text search, best match first
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        for title, description in [('Buy milk', 'groceries'), ('Write report', 'milk the numbers'),
+                                   ('Call mom', 'family')]:
+            db.session.add(Todo(title=title, description=description, completed=False,
+                                deadline=datetime(2024, 1, 5), user_id=self.user.id))
+        db.session.commit()
+        todo = Todo.query.filter_by(title='Call mom').first()
+        todo.title = 'Call mom about milk'
+        db.session.commit()
+        response = self.client.get('/api/v1/todos?q=milk', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([todo['title'] for todo in response.json['data']][0], 'Buy milk')
+        self.assertEqual(response.json['count'], 3)
+        # Keyset pages of a search follow the sort key, not the relevance
+        response = self.client.get('/api/v1/todos?q=milk&limit=10', headers=headers)
+        self.assertEqual([todo['title'] for todo in response.json['data']],
+                         ['Buy milk', 'Write report', 'Call mom about milk'])
+        response = self.client.get(
+            '/api/v1/todos?q=milk "numbers', headers=headers)
+        self.assertEqual([todo['title'] for todo in response.json['data']], ['Write report'])
+
+    def test_get_todos_cache_invalidation(self):
+        """
+        Should serve the cached list until the user writes and never share it between users
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        response = self.client.get('/api/v1/todos', headers=headers)
+        self.assertEqual(response.json['count'], 0)
+        db.session.add(Todo(title='Hidden Todo', description='Testing', completed=False,
+                            deadline=datetime(2024, 1, 5), user_id=self.user.id))
+        db.session.commit()
+        response = self.client.get('/api/v1/todos', headers=headers)
+        self.assertEqual(response.json['count'], 0)
+        self.client.post('/api/v1/todos', json={'title': 'Test Todo', 'description': 'Testing',
+                                                'completed': False, 'deadline': '01/01/24 12:00:00'}, headers=headers)
+        response = self.client.get('/api/v1/todos', headers=headers)
+        self.assertEqual(response.json['count'], 2)
+
+        other_user = User(name=fake.name(), email=fake.email(), password="password",
+                          role='simple', token=token_hex(16))
+        db.session.add(other_user)
+        db.session.commit()
+        access_token = create_access_token(identity=other_user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        response = self.client.get('/api/v1/todos', headers=headers)
+        self.assertEqual(response.json['count'], 0)
+
     def test_get_todo_route(self):
         """
         Should only return 1 todo of the user and status code 200
@@ -133,6 +379,358 @@ class TestApp(TestCase):
         self.assertTrue(response.json['requestStatus'])
         self.assertEqual(response.json['data']['title'], 'Test Todo')
 
+    def test_get_todo_single_statement(self):
+        """
+        Should read a todo with exactly one SQL statement when the token carries the user claims
+        """
+        access_token = create_access_token(
+            identity=self.user.email, additional_claims=identity_claims(self.user))
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        todo = Todo(title='Test Todo', description='Testing', completed=False,
+                    deadline=datetime(2024, 1, 5), user_id=self.user.id)
+        db.session.add(todo)
+        db.session.commit()
+        todo_id = todo.id
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            response = self.client.get(
+                f'/api/v1/todos/{todo_id}', headers=headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(statements), 1, statements)
+
+    def test_todo_stats(self):
+        """
+        Should keep the counters in step with every write and repair drift
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        db.session.add(Todo(title='Loaded', description='Testing', completed=True,
+                            deadline=datetime(2024, 1, 5), user_id=self.user.id))
+        db.session.commit()
+
+        def stats():
+            response = self.client.get('/api/v1/todos/stats', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            return response.json['data']
+        # Counters of a user created outside the API are counted, not stored
+        # by a read
+        self.assertEqual(stats(), {'total': 1, 'completed': 1, 'open': 0, 'overdue': 0})
+        self.assertIsNone(db.session.get(TodoStats, self.user.id))
+
+        body = {'title': 'Todo', 'description': 'Testing', 'completed': False,
+                'deadline': '01/01/20 12:00:00'}
+        todo_id = self.client.post('/api/v1/todos', json=body, headers=headers).json['data']['id']
+        self.client.post('/api/v1/todos:batch', headers=headers, json={'items': [
+            dict(body, completed=True), dict(body, deadline='01/01/60 12:00:00')]})
+        self.assertEqual(stats(), {'total': 4, 'completed': 2, 'open': 2, 'overdue': 1})
+
+        self.client.put(f'/api/v1/todos/{todo_id}', json=dict(body, completed=True), headers=headers)
+        self.assertEqual(stats(), {'total': 4, 'completed': 3, 'open': 1, 'overdue': 0})
+        ids = [todo['id'] for todo in self.client.get('/api/v1/todos', headers=headers).json['data']]
+        self.client.patch('/api/v1/todos:batch', headers=headers, json={'items': [
+            dict(body, id=ids[0], completed=False), dict(body, id=ids[1], completed=False)]})
+        self.assertEqual(stats(), {'total': 4, 'completed': 1, 'open': 3, 'overdue': 2})
+        self.client.delete(f'/api/v1/todos/{ids[0]}', headers=headers)
+        self.client.delete('/api/v1/todos:batch', headers=headers, json={'ids': ids[1:3]})
+        self.assertEqual(stats(), {'total': 1, 'completed': 0, 'open': 1, 'overdue': 0})
+
+        response = self.client.get('/api/v1/todos', headers=headers)
+        self.assertEqual(response.json['total'], 1)
+        response = self.client.get('/api/v1/todos?completed=true', headers=headers)
+        self.assertEqual((response.json['total'], response.json['count']), (0, 0))
+
+        db.session.get(TodoStats, self.user.id).total = 7
+        db.session.commit()
+        self.assertEqual(reconcile_todo_stats(), {self.user.id: ((7, 0), (1, 0))})
+        self.assertEqual(reconcile_todo_stats(), {})
+
+    def test_todo_changes(self):
+        """
+        Should return the todos written and deleted since a sync token, in
+        revision order, and 410 once the tombstones were compacted
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        body = {'title': 'Todo', 'description': 'Testing', 'completed': False,
+                'deadline': '01/01/24 12:00:00'}
+        ids = [result['data']['id'] for result in self.client.post('/api/v1/todos:batch', headers=headers, json={
+            'items': [dict(body, title=f'Todo {i}') for i in range(3)]}).json['results']]
+
+        response = self.client.get('/api/v1/todos/changes?limit=2', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(([change['title'] for change in response.json['changes']], response.json['has_more']),
+                         (['Todo 0', 'Todo 1'], True))
+        response = self.client.get(f"/api/v1/todos/changes?since={response.json['next_since']}", headers=headers)
+        self.assertEqual(([change['title'] for change in response.json['changes']], response.json['has_more']),
+                         (['Todo 2'], False))
+        since = response.json['next_since']
+        response = self.client.get(f'/api/v1/todos/changes?since={since}', headers=headers)
+        self.assertEqual((response.json['count'], response.json['next_since']), (0, since))
+
+        self.client.put(f'/api/v1/todos/{ids[0]}', json=dict(body, completed=True), headers=headers)
+        self.client.delete(f'/api/v1/todos/{ids[1]}', headers=headers)
+        self.client.delete('/api/v1/todos:batch', json={'ids': [ids[2], -1]}, headers=headers)
+        response = self.client.get(f'/api/v1/todos/changes?since={since}', headers=headers)
+        self.assertEqual([(change['id'], change['deleted']) for change in response.json['changes']],
+                         [(ids[0], False), (ids[1], True), (ids[2], True)])
+        self.assertTrue(response.json['changes'][0]['completed'])
+        revisions = [change['revision'] for change in response.json['changes']]
+        self.assertEqual(revisions, sorted(set(revisions)))
+
+        self.assertEqual(self.client.get('/api/v1/todos/changes?since=bad', headers=headers).status_code, 400)
+        self.assertEqual(compact_tombstones(datetime.utcnow() + timedelta(seconds=1)), 2)
+        response = self.client.get(f'/api/v1/todos/changes?since={since}', headers=headers)
+        self.assertEqual(response.status_code, 410)
+        response = self.client.get('/api/v1/todos/changes', headers=headers)
+        self.assertEqual([change['id'] for change in response.json['changes']], [ids[0]])
+
+    def test_todo_changes_full_sync_after_compaction(self):
+        """
+        Should page through a full sync started after a compaction, and still
+        expire its tokens once tombstones newer than its start are compacted
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        body = {'title': 'Todo', 'description': 'Testing', 'completed': False,
+                'deadline': '01/01/24 12:00:00'}
+        ids = [result['data']['id'] for result in self.client.post('/api/v1/todos:batch', headers=headers, json={
+            'items': [dict(body, title=f'Todo {i}') for i in range(5)]}).json['results']]
+        self.client.delete(f'/api/v1/todos/{ids[0]}', headers=headers)
+        self.assertEqual(compact_tombstones(datetime.utcnow() + timedelta(seconds=1)), 1)
+
+        synced, url = [], '/api/v1/todos/changes?limit=2'
+        while True:
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            synced += [change['id'] for change in response.json['changes']]
+            if not response.json['has_more']:
+                break
+            url = f"/api/v1/todos/changes?limit=2&since={response.json['next_since']}"
+        self.assertEqual(synced, ids[1:])
+
+        response = self.client.get('/api/v1/todos/changes?limit=2', headers=headers)
+        since = response.json['next_since']
+        self.client.delete(f'/api/v1/todos/{ids[4]}', headers=headers)
+        self.assertEqual(compact_tombstones(datetime.utcnow() + timedelta(seconds=1)), 1)
+        response = self.client.get(f'/api/v1/todos/changes?limit=2&since={since}', headers=headers)
+        self.assertEqual(response.status_code, 410)
+
+    def test_read_replica_routing(self):
+        """
+        Should read GET requests from the replicas in turn, from the primary
+        after a write of the user or when the replicas are down
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        replica_engine = create_engine('sqlite:///test_replica.db')
+        db.metadata.create_all(replica_engine)
+        with replica_engine.begin() as connection:
+            connection.execute(User.__table__.insert(), {
+                'id': self.user.id, 'name': self.user.name, 'email': self.user.email,
+                'password': self.user.password, 'role': 'simple', 'token': self.user.token})
+            connection.execute(Todo.__table__.insert(), {
+                'id': 1000, 'title': 'On replica', 'description': 'Testing', 'completed': False,
+                'user_id': self.user.id, 'created_at': datetime.utcnow(), 'updated_at': datetime.utcnow()})
+        broken = Replica('replica_broken', create_engine('sqlite:////nonexistent/replica.db'))
+        read_replicas.replicas = [Replica('replica_0', replica_engine), broken]
+        try:
+            self.assertCountEqual([read_replicas.choose() for _ in range(2)], read_replicas.replicas)
+            read_replicas.mark_down(broken, 'down')
+            self.assertEqual([read_replicas.choose() for _ in range(2)], [read_replicas.replicas[0]] * 2)
+
+            response = self.client.get('/api/v1/todos/1000', headers=headers)
+            self.assertEqual(response.json['data']['title'], 'On replica')
+            self.assertEqual(Todo.query.count(), 0)
+
+            # Read your own writes
+            body = {'title': 'On primary', 'description': 'Testing', 'completed': False,
+                    'deadline': '01/01/24 12:00:00'}
+            todo_id = self.client.post('/api/v1/todos', json=body, headers=headers).json['data']['id']
+            response = self.client.get(f'/api/v1/todos/{todo_id}', headers=headers)
+            self.assertEqual(response.json['data']['title'], 'On primary')
+            self.assertEqual(self.client.get('/api/v1/todos/1000', headers=headers).status_code, 404)
+
+            layered_cache.clear()
+            self.assertEqual(self.client.get('/api/v1/todos/1000', headers=headers).status_code, 200)
+            # Read from a replica soon after a write: only cached for the stickiness
+            layered_cache.clear()
+            cache.set(f'db_primary:{self.user.email}', time.time() - 10)
+            self.assertEqual(self.client.get('/api/v1/todos/1000', headers=headers).status_code, 200)
+            fresh_until = [stored[0][1] for key, stored in layered_cache.local._entries.items()
+                           if key.startswith('todos:')]
+            self.assertEqual(len(fresh_until), 1)
+            self.assertLessEqual(fresh_until[0], time.time() + app.config['DB_REPLICA_STICKINESS'])
+            # ... and never under the collection ETag of a primary read
+            replica_etag = self.client.get('/api/v1/todos', headers=headers).headers['ETag']
+            generation = cache.get(f'todos_generation:{self.user.id}')
+            layered_cache.clear()
+            cache.set(f'todos_generation:{self.user.id}', generation, timeout=0)
+            cache.set(f'db_primary:{self.user.email}', time.time())
+            response = self.client.get('/api/v1/todos', headers=dict(headers, **{'If-None-Match': replica_etag}))
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], replica_etag)
+            layered_cache.clear()
+            cache.set(f'db_primary:{self.user.email}', time.time() - 10)
+            read_replicas.mark_down(read_replicas.replicas[0], 'down')
+            read_replicas.replicas[0].down_until = 1
+            broken.down_until = float('inf')
+            layered_cache.clear()
+            # The replica answers its health check again
+            self.assertEqual(self.client.get('/api/v1/todos/1000', headers=headers).status_code, 200)
+            self.assertEqual(read_replicas.replicas[0].down_until, 0)
+            read_replicas.mark_down(read_replicas.replicas[0], 'down')
+            layered_cache.clear()
+            self.assertEqual(self.client.get('/api/v1/todos/1000', headers=headers).status_code, 404)
+
+            # A replica failing the read of a request: the read runs again on the primary
+            event.listen(broken.engine, 'handle_error', read_replicas._handle_error(broken))
+            broken.down_until = 0
+            layered_cache.clear()
+            response = self.client.get(f'/api/v1/todos/{todo_id}', headers=headers)
+            self.assertEqual((response.status_code, response.json['data']['title']), (200, 'On primary'))
+            self.assertGreater(broken.down_until, 0)
+        finally:
+            read_replicas.replicas = []
+            replica_engine.dispose()
+            os.remove('test_replica.db')
+
+    def test_conditional_todo_routes(self):
+        """
+        Should answer 304 to a matching If-None-Match and 412 to a stale If-Match
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        todo = Todo(title='Test Todo', description='Testing', completed=False,
+                    deadline=datetime(2024, 1, 5), user_id=self.user.id)
+        db.session.add(todo)
+        db.session.commit()
+        todo_id = todo.id
+        response = self.client.get('/api/v1/todos', headers=headers)
+        list_etag = response.headers['ETag']
+        response = self.client.get('/api/v1/todos', headers=dict(headers, **{'If-None-Match': list_etag}))
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(f'/api/v1/todos/{todo_id}', headers=headers)
+        etag = response.headers['ETag']
+        for _ in range(2):
+            response = self.client.get(f'/api/v1/todos/{todo_id}',
+                                       headers=dict(headers, **{'If-None-Match': etag}))
+            self.assertEqual(response.status_code, 304)
+
+        body = {'title': 'Test Todo Updated', 'description': 'Testing',
+                'completed': False, 'deadline': '01/01/24 12:00:00'}
+        response = self.client.put(f'/api/v1/todos/{todo_id}', json=body,
+                                   headers=dict(headers, **{'If-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        response = self.client.put(f'/api/v1/todos/{todo_id}', json=body,
+                                   headers=dict(headers, **{'If-Match': etag}))
+        self.assertEqual(response.status_code, 412)
+        response = self.client.delete(f'/api/v1/todos/{todo_id}',
+                                      headers=dict(headers, **{'If-Match': etag}))
+        self.assertEqual(response.status_code, 412)
+        response = self.client.get('/api/v1/todos', headers=dict(headers, **{'If-None-Match': list_etag}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_cached_compressed_variants(self):
+        """
+        Should serve the cached todo lists in the accepted encoding without
+        compressing them again
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        db.session.add_all([Todo(title=f'Test Todo {i}', description='Testing', completed=False,
+                                 deadline=datetime(2024, 1, 5), user_id=self.user.id) for i in range(20)])
+        db.session.commit()
+        plain = self.client.get('/api/v1/todos', headers=headers)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        with mock.patch('caching.brotli.compress', side_effect=AssertionError), \
+                mock.patch('caching.gzip.compress', side_effect=AssertionError), \
+                mock.patch('flask_compress.flask_compress.Compress.compress', side_effect=AssertionError):
+            response = self.client.get('/api/v1/todos', headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(response.data), plain.data)
+            response = self.client.get('/api/v1/todos',
+                                       headers=dict(headers, **{'Accept-Encoding': 'gzip, deflate, br'}))
+            self.assertEqual(response.headers['Content-Encoding'], 'br')
+            self.assertEqual(brotli.decompress(response.data), plain.data)
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+            self.assertEqual(response.headers['ETag'], plain.headers['ETag'][:-1] + ':br"')
+            response = self.client.get('/api/v1/todos', headers=dict(headers, **{
+                'Accept-Encoding': 'br', 'If-None-Match': response.headers['ETag']}))
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get('/api/v1/todos', headers=dict(headers, **{'Accept-Encoding': 'deflate'}))
+            self.assertEqual(response.headers['Content-Encoding'], 'identity')
+            self.assertEqual((response.data, response.headers['ETag']), (plain.data, plain.headers['ETag']))
+
+    def test_layered_cache(self):
+        """
+        Should keep shared keys locally until invalidated from another
+        process, compute a missing entry once and serve stale entries while
+        another process recomputes them
+        """
+        local = LocalCache(max_entries=2)
+        local.set('a', 1, 60)
+        local.set('b', 2, 60)
+        local.get('a')
+        local.set('c', 3, 60)
+        self.assertEqual((local.get('a'), local.get('b'), local.get('c')), (1, None, 3))
+
+        # Two workers sharing the remote cache and the invalidation bus
+        bus = LocalBus()
+        first, second = LayeredCache(cache), LayeredCache(cache)
+        first.init_app(app, bus)
+        second.init_app(app, bus)
+        cache.set('todos_generation:test', 1)
+        self.assertEqual(first.get_shared('todos_generation:test'), 1)
+        cache.set('todos_generation:test', 2)
+        self.assertEqual(first.get_shared('todos_generation:test'), 1)
+        second.invalidate('todos_generation:test')
+        self.assertEqual(first.get_shared('todos_generation:test'), 2)
+
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'computed'
+
+        def fetch(results):
+            with app.app_context():
+                results.append(first.fetch('todos:test', compute, 60))
+        results = []
+        threads = [threading.Thread(target=fetch, args=(results,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((results, len(calls)), (['computed'] * 8, 1))
+        self.assertEqual(second.fetch('todos:test', compute, 60), 'computed')
+        self.assertEqual(len(calls), 1)
+        entry = cache.get('todos:test')
+        self.assertTrue(time.time() + 53 < entry[1] <= time.time() + 60)
+
+        second.set('todos:stale', 'stale', 0)
+        cache.add('todos:stale:lock', 1)
+        self.assertEqual(first.fetch('todos:stale', compute, 60), 'stale')
+        self.assertEqual(len(calls), 1)
+        cache.delete('todos:stale:lock')
+        self.assertEqual(first.fetch('todos:stale', compute, 60), 'computed')
+        self.assertEqual(second.fetch('todos:stale', compute, 60), 'computed')
+        self.assertEqual(len(calls), 2)
+
     def test_update_todo_route(self):
         """
         Should return status code 200 and todo updated 
@@ -173,6 +771,260 @@ class TestApp(TestCase):
         self.assertTrue(response.json['requestStatus'])
         self.assertEqual(response.json['message'], 'TodoDeleted')
 
+    def test_batch_routes(self):
+        """
+        Should create, update and delete todos in one request each with per-item results
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        items = [{'title': f'Test Todo {i}', 'description': 'Testing', 'completed': False,
+                  'deadline': '01/01/24 12:00:00'} for i in range(3)]
+        response = self.client.post(
+            '/api/v1/todos:batch', json={'items': items + [{'title': 'Test Todo'}]}, headers=headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['errors'][0]['index'], 3)
+        self.assertEqual(Todo.query.count(), 0)
+
+        response = self.client.post(
+            '/api/v1/todos:batch', json={'items': items}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        ids = [result['data']['id'] for result in response.json['results']]
+        self.assertEqual([result['data']['title'] for result in response.json['results']],
+                         ['Test Todo 0', 'Test Todo 1', 'Test Todo 2'])
+
+        response = self.client.patch('/api/v1/todos:batch', json={'items': [
+            dict(items[0], id=ids[0], completed=True), dict(items[1], id=-1)]}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status']
+                         for result in response.json['results']], [200, 404])
+        self.assertTrue(db.session.get(Todo, ids[0]).completed)
+
+        # Partial items: only the given fields change
+        response = self.client.patch('/api/v1/todos:batch', json={'items': [
+            {'id': ids[1], 'completed': True}, {'id': ids[2], 'title': 'Renamed'}]}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        db.session.expire_all()
+        self.assertEqual((db.session.get(Todo, ids[1]).completed, db.session.get(Todo, ids[1]).title),
+                         (True, 'Test Todo 1'))
+        self.assertEqual((db.session.get(Todo, ids[2]).completed, db.session.get(Todo, ids[2]).title),
+                         (False, 'Renamed'))
+        self.assertEqual(db.session.get(TodoStats, self.user.id).completed, 2)
+
+        # Only a new deadline gets the todo reminded again
+        reminded_at = datetime(2023, 12, 31, 11)
+        db.session.execute(db.update(Todo).where(Todo.id.in_(ids[:2])).values(reminded_at=reminded_at))
+        db.session.commit()
+        response = self.client.patch('/api/v1/todos:batch', json={'items': [
+            dict(items[0], id=ids[0]), dict(items[1], id=ids[1], deadline='01/02/24 12:00:00')]}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        db.session.expire_all()
+        self.assertEqual((db.session.get(Todo, ids[0]).reminded_at, db.session.get(Todo, ids[1]).reminded_at),
+                         (reminded_at, None))
+
+        response = self.client.delete(
+            '/api/v1/todos:batch', json={'ids': ids[:2] + [-1]}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['count'], 2)
+        self.assertEqual(Todo.query.count(), 1)
+
+    def test_request_validation(self):
+        """
+        Should answer 400 to an invalid body and 413 to an oversized one
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        body = {'title': 'Todo', 'description': 'Testing', 'completed': False,
+                'deadline': '01/01/24 12:00:00'}
+        for invalid, message in [(None, "Empty body"),
+                                 ({k: v for k, v in body.items() if k != 'title'}, "Champ title requis"),
+                                 (dict(body, completed=1), "Champ completed doit être de type <class 'bool'>"),
+                                 (dict(body, deadline='2024-01-01'), "Champ deadline doit respecter le format %m/%d/%y %H:%M:%S"),
+                                 (dict(body, title='x' * 101), "Champ title doit faire au plus 100 caractères"),
+                                 (dict(body, user_id=1), "Champ user_id inconnu")]:
+            response = self.client.post('/api/v1/todos', json=invalid, headers=headers)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json['message'], message)
+        response = self.client.post('/api/v1/todos', json=dict(body, description='x' * app.config['MAX_CONTENT_LENGTH']),
+                                    headers=headers)
+        self.assertEqual(response.status_code, 413)
+        response = self.client.delete('/api/v1/todos:batch', json={'ids': [1, True]}, headers=headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.patch('/api/v1/todos:batch', json={'items': [{'title': 'Todo'}]}, headers=headers)
+        self.assertEqual(response.json['errors'][0]['message'], "Champ id requis")
+        self.assertEqual(Todo.query.count(), 0)
+
+    def test_export_route(self):
+        """
+        Should stream all todos of the user as gzipped NDJSON or as CSV
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        for i in range(3):
+            db.session.add(Todo(title=f'Test Todo {i}', description='Testing', completed=False,
+                                deadline=datetime(2024, 1, 5) if i else None, user_id=self.user.id))
+        db.session.commit()
+        response = self.client.get('/api/v1/todos/export?format=ndjson',
+                                   headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(response.data).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['title'] for line in lines], [
+                         'Test Todo 0', 'Test Todo 1', 'Test Todo 2'])
+        response = self.client.get(
+            '/api/v1/todos/export?format=csv', headers=headers)
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(len(response.data.decode('utf-8').splitlines()), 4)
+
+    def test_send_reminders(self):
+        """
+        Should remind subscribed users once of their todos entering the reminder window
+        """
+        self.user.has_subscribed = True
+        now = datetime(2024, 1, 5, 12)
+        for i, deadline in enumerate([now + timedelta(minutes=30), now - timedelta(hours=2),
+                                      now + timedelta(hours=3), now - timedelta(days=3)]):
+            db.session.add(Todo(title=f'Test Todo {i}', description='Testing', completed=False,
+                                deadline=deadline, user_id=self.user.id))
+        db.session.add(Todo(title='Done Todo', description='Testing', completed=True,
+                            deadline=now, user_id=self.user.id))
+        db.session.commit()
+        self.assertEqual(send_reminders(now), 1)
+        self.assertEqual(send_reminders(now), 0)
+        mailer.join()
+        self.assertEqual(len(mailer.transport.outbox), 1)
+        self.assertEqual(mailer.transport.outbox[0]['recipient'], self.user.email)
+        body = mailer.transport.outbox[0]['body']
+        self.assertIn('Test Todo 0', body)
+        self.assertIn('Test Todo 1', body)
+        self.assertNotIn('Test Todo 2', body)
+        self.assertNotIn('Test Todo 3', body)
+        self.assertNotIn('Done Todo', body)
+
+    def test_metrics_route(self):
+        """
+        Should expose request latency, SQL and cache metrics in Prometheus text format
+        """
+        access_token = create_access_token(identity=self.user.email)
+        headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        self.client.set_cookie('access_token_cookie', access_token)
+        self.client.get('/api/v1/todos', headers=headers)
+        self.client.get('/api/v1/todos', headers=headers)
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        body = response.data.decode('utf-8')
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        self.assertIn('http_request_duration_seconds_count{endpoint="api.get_todos",method="GET",status="200"}', body)
+        self.assertIn('db_queries_total{endpoint="api.get_todos"}', body)
+        self.assertIn('cache_requests_total{prefix="todos",result="miss"}', body)
+        self.assertIn('cache_local_requests_total{prefix="todos",result="hit"}', body)
+
+        # Building another app does not count the statements and lookups twice
+        create_app()
+        metrics = app.extensions['metrics']
+        cache.get('other:key')
+        self.assertEqual(
+            metrics.registry.counters[('cache_requests_total', (('prefix', 'other'), ('result', 'miss')))], 1)
+        metrics._start_request()
+        db.session.execute(text('SELECT 1'))
+        self.assertEqual(g.metrics_queries, 1)
+
+    def test_metrics_exited_workers(self):
+        """
+        Should fold the dumps of exited workers into one aggregate without
+        losing or double counting them
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            reset_metrics_dir(directory)
+            workers = [Metrics() for _ in range(3)]
+            for pid, worker in enumerate(workers, start=1):
+                worker.directory = directory
+                worker.registry.inc('db_queries_total', {'endpoint': 'background'}, pid)
+                with mock.patch('os.getpid', return_value=pid):
+                    worker.flush()
+            scraper = Metrics()
+            scraper.directory = directory
+
+            def total():
+                counters, _ = scraper.collect()
+                return counters[('db_queries_total', (('endpoint', 'background'),))]
+            self.assertEqual(total(), 6)
+            fold_worker_metrics(directory, 1)
+            fold_worker_metrics(directory, 2)
+            self.assertEqual(total(), 6)
+            self.assertEqual(sorted(os.listdir(directory)), ['metrics-3.json', 'metrics-exited.json'])
+            # A recycled pid does not overwrite the counters of the exited worker
+            with mock.patch('os.getpid', return_value=1):
+                workers[0].flush()
+            self.assertEqual(total(), 7)
+            reset_metrics_dir(directory)
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_log_queue_full(self):
+        """
+        Should drop debug records past the high water mark, info records when
+        the queue is full and count every dropped record
+        """
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=5), [], high_water=0.6)
+        with mock.patch.object(handler, 'start'):
+            for level in [logging.DEBUG] * 4 + [logging.INFO] * 3 + [logging.WARNING]:
+                handler.handle(logging.makeLogRecord({'msg': {'message': 'test'}, 'levelno': level}))
+        self.assertEqual((handler.queue.qsize(), handler.dropped), (5, 3))
+        levels = [handler.queue.get_nowait().levelno for _ in range(5)]
+        self.assertEqual(levels, [logging.DEBUG] * 3 + [logging.INFO] * 2)
+
+    def test_log_route_filter(self):
+        """
+        Should apply the per-route levels and sampling to the records of a
+        request, never to warnings or to records outside of a request
+        """
+        route_filter = RouteFilter({'api.get_todos': 'WARNING'}, {'api.get_one_todo': 0.0})
+
+        def passes(level):
+            return route_filter.filter(logging.makeLogRecord({'msg': 'test', 'levelno': level}))
+        with app.test_request_context('/api/v1/todos'):
+            self.assertEqual([passes(logging.INFO), passes(logging.WARNING)], [False, True])
+        with app.test_request_context('/api/v1/todos/1'):
+            self.assertEqual([passes(logging.INFO), passes(logging.ERROR)], [False, True])
+        with app.test_request_context('/api/v1/todos/stats'):
+            self.assertTrue(passes(logging.INFO))
+        self.assertTrue(passes(logging.DEBUG))
+
+    def test_log_cloudwatch_fallback(self):
+        """
+        Should write to the fallback handler, with a warning on the console,
+        when the CloudWatch handler cannot be built
+        """
+        def cloudwatch():
+            raise RuntimeError('unreachable')
+        console, fallback = BufferingHandler(10), BufferingHandler(10)
+        handler = LazyHandler(cloudwatch, lambda: fallback, console)
+        for _ in range(2):
+            handler.handle(logging.makeLogRecord({'msg': {'message': 'test'}, 'levelno': logging.INFO}))
+        self.assertIs(handler.handler, fallback)
+        self.assertEqual([record.msg['message'] for record in fallback.buffer], ['test', 'test'])
+        self.assertEqual([record.msg for record in console.buffer],
+                         [{'message': 'cloudwatch_unavailable', 'error': 'unreachable'}])
+
+    def test_request_duration_log(self):
+        """
+        Should log one record with the endpoint, status and duration of each request
+        """
+        records = BufferingHandler(10)
+        logging.getLogger('app.requests').addHandler(records)
+        try:
+            self.client.get('/')
+        finally:
+            logging.getLogger('app.requests').removeHandler(records)
+        self.assertEqual(len(records.buffer), 1)
+        entry = records.buffer[0].msg
+        self.assertEqual({key: entry[key] for key in ('message', 'endpoint', 'method', 'path', 'status')},
+                         {'message': 'request', 'endpoint': 'api.hello', 'method': 'GET', 'path': '/',
+                          'status': 200})
+        self.assertGreaterEqual(entry['duration_ms'], 0)
+
     def test_logout_route(self):
         """
         Should return status code 200 and message LoggedOut
@@ -1,29 +1,17 @@
+import base64
+from collections import OrderedDict
+from datetime import datetime
 from functools import wraps
+import json
 import logging
-from flask import request
-from flask_jwt_extended import get_jwt_identity
-from models import Todo, User
+import threading
+import time
+from flask import current_app, request
+from sqlalchemy import and_, column, func, literal_column, or_, table
+from flask_jwt_extended import get_jwt, get_jwt_identity
+from models import Todo, User, db
 
-
-def verify_body(required_fields):
-    def _verify_body(f):
-        @wraps(f)
-        def __verify_body(*args, **kwargs):
-            data = request.get_json(silent=True)
-
-            if (not data):
-                return {'message': "Empty body", 'status': 'FAILED'}
-            if (len(data) != len(required_fields)):
-                return {'message': "Longueur body incorrect", 'status': 'FAILED'}
-            for required_field in required_fields:
-                body_property = data.get(required_field[0])
-                if (required_field[0] not in data):
-                    return {"message": f"Champ {required_field[0]} requis", 'status': 'FAILED'}
-                if (not type(body_property) is required_field[1]):
-                    return {"message": f"Champ {required_field[0]} doit être de type {required_field[1]}", 'status': 'FAILED'}
-            return f(*args, **kwargs)
-        return __verify_body
-    return _verify_body
+DEADLINE_FORMAT = '%m/%d/%y %H:%M:%S'
 
 
 def is_user_todo():
@@ -31,24 +19,109 @@ def is_user_todo():
         @wraps(f)
         def __is_user_todo(*args, **kwargs):
             result = f(*args, **kwargs)
-            current_identity = User.query.filter_by(
-                email=get_jwt_identity()).first()
-            if (any(todo.id == int(request.view_args.get('id_todo')) for todo in current_identity.todos)):
+            todo = db.session.query(Todo.id).filter(
+                Todo.id == int(request.view_args.get('id_todo')), Todo.user_id == current_user_id()).first()
+            if (todo):
                 return result
             return {"requestStatus": False, "message": "NotAuthorized"}, 401
         return __is_user_todo
     return _is_user_todo
 
 
+class IdentityCache:
+    """
+    Small in-process TTL cache mapping a JWT identity (email) to the user's
+    id and role, for tokens issued before they carried these claims. A LRU
+    of at most IDENTITY_CACHE_MAX_ENTRIES identities.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, identity):
+        with self._lock:
+            entry = self._entries.get(identity)
+            if (entry is None):
+                return None
+            if (entry[0] < time.monotonic()):
+                del self._entries[identity]
+                return None
+            self._entries.move_to_end(identity)
+            return entry[1]
+
+    def set(self, identity, user):
+        ttl = current_app.config.get('IDENTITY_CACHE_TTL', 300)
+        max_entries = current_app.config.get('IDENTITY_CACHE_MAX_ENTRIES', 10000)
+        entry = identity_claims(user)
+        now = time.monotonic()
+        with self._lock:
+            self._entries.pop(identity, None)
+            self._entries[identity] = (now + ttl, entry)
+            # Least recently used first: expired entries or beyond the bound
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest[0] >= now and len(self._entries) <= max_entries:
+                    break
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, identity=None):
+        with self._lock:
+            if identity is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(identity, None)
+
+
+identity_cache = IdentityCache()
+
+
+def identity_claims(user):
+    return {'user_id': user.id, 'role': user.role}
+
+
+def current_identity():
+    """
+    id and role of the authenticated user, read from the JWT claims and
+    only falling back to the database for tokens without them
+    """
+    claims = get_jwt()
+    if 'user_id' in claims:
+        return {'user_id': claims['user_id'], 'role': claims.get('role')}
+    identity = get_jwt_identity()
+    cached = identity_cache.get(identity)
+    if cached is not None:
+        return cached
+    user = User.query.filter_by(email=identity).first()
+    if user is None:
+        return {'user_id': None, 'role': None}
+    return identity_cache.set(identity, user)
+
+
+def current_user_id():
+    return current_identity()['user_id']
+
+
+def completed_filter(args):
+    """
+    True for ?completed=true, False for any other value, None without it
+    """
+    completed = args.get('completed', None, type=str)
+    if completed is None:
+        return None
+    return completed.lower() == 'true'
+
+
 def build_query(args, user_id):
     query = Todo.query
 
-    completed = args.get('completed', None, type=bool)
+    completed = completed_filter(args)
     deadline = args.get('deadline', None, type=str)
     description = args.get('description', None, type=str)
     title = args.get('title', None, type=str)
+    search = args.get('q', None, type=str)
     if completed is not None:
-        completed = True if completed == "true" else False
         query = query.filter(Todo.completed == completed)
     if deadline:
         query = query.filter(Todo.deadline == deadline)
@@ -57,4 +130,130 @@ def build_query(args, user_id):
     if title:
         query = query.filter(Todo.title.ilike(f"%{title}%"))
     query = query.filter(Todo.user_id == user_id)
+    if search and search.strip():
+        query = full_text_search(query, search)
     return query
+
+
+todo_fts = table('todo_fts', column('rowid'))
+
+
+def full_text_search(query, search):
+    """
+    Filter on the maintained full-text index of title/description (see
+    TODO_SEARCH_DDL) and order by relevance
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        search_vector = literal_column('todo.search_vector')
+        ts_query = func.websearch_to_tsquery('simple', search)
+        return query.filter(search_vector.op('@@')(ts_query)).order_by(
+            func.ts_rank_cd(search_vector, ts_query).desc())
+    # Every term is quoted so that user input is never parsed as FTS5 syntax
+    match = ' '.join('"' + term.replace('"', '""') + '"' for term in search.split())
+    return query.join(todo_fts, todo_fts.c.rowid == Todo.id).filter(
+        literal_column('todo_fts').op('MATCH')(match)).order_by(literal_column('todo_fts.rank'))
+
+
+CURSOR_SORT_KEYS = {
+    'id': Todo.id,
+    'deadline': Todo.deadline,
+    'created_at': Todo.created_at,
+}
+DEFAULT_CURSOR_LIMIT = 100
+MAX_CURSOR_LIMIT = 1000
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(sort, value, id_todo):
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([sort, value, id_todo], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, sort):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        cursor_sort, value, id_todo = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidCursor("CursorNotValid")
+    if cursor_sort != sort or not isinstance(id_todo, int):
+        raise InvalidCursor("CursorNotValid")
+    if sort == 'revision':
+        # A revision, or a [revision, horizon] pair for the sync tokens
+        if not (isinstance(value, int) or (isinstance(value, list) and len(value) == 2
+                                           and all(isinstance(item, int) for item in value))):
+            raise InvalidCursor("CursorNotValid")
+    elif sort != 'id' and value is not None:
+        try:
+            value = datetime.fromisoformat(value)
+        except (ValueError, TypeError):
+            raise InvalidCursor("CursorNotValid")
+    return value, id_todo
+
+
+def _seek_condition(column, value, id_todo, forward):
+    """
+    Row-value comparison on (column, id) with NULLs sorted last,
+    written out so that it works on both SQLite and Postgres
+    """
+    if column is Todo.id:
+        return Todo.id > id_todo if forward else Todo.id < id_todo
+    if forward:
+        if value is None:
+            return and_(column.is_(None), Todo.id > id_todo)
+        return or_(column > value, and_(column == value, Todo.id > id_todo), column.is_(None))
+    if value is None:
+        return or_(column.isnot(None), and_(column.is_(None), Todo.id < id_todo))
+    return or_(column < value, and_(column == value, Todo.id < id_todo))
+
+
+def paginate_keyset(query, args):
+    """
+    Keyset pagination on top of build_query: `after`/`before` are opaque
+    cursors encoding (sort key, id) of the last/first row seen, so deep pages
+    cost the same as the first one (no OFFSET, no COUNT). The rows are in
+    the order of the sort key: a full-text search (q) only filters them, its
+    relevance order is only kept by the page mode.
+    """
+    sort = args.get('sort', 'id', type=str)
+    if sort not in CURSOR_SORT_KEYS:
+        raise InvalidCursor("SortNotValid")
+    limit = args.get('limit', DEFAULT_CURSOR_LIMIT, type=int)
+    limit = max(1, min(limit, MAX_CURSOR_LIMIT))
+    after = args.get('after', None, type=str)
+    before = args.get('before', None, type=str)
+    if after and before:
+        raise InvalidCursor("CursorNotValid")
+    column = CURSOR_SORT_KEYS[sort]
+    forward = before is None
+
+    if after or before:
+        value, id_todo = decode_cursor(after or before, sort)
+        query = query.filter(_seek_condition(column, value, id_todo, forward))
+    if column is Todo.id:
+        order = [Todo.id.asc()] if forward else [Todo.id.desc()]
+    elif forward:
+        order = [column.asc().nulls_last(), Todo.id.asc()]
+    else:
+        order = [column.desc().nulls_first(), Todo.id.desc()]
+    rows = query.order_by(None).order_by(*order).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not forward:
+        rows.reverse()
+
+    def cursor_of(row):
+        return encode_cursor(sort, getattr(row, column.key), row.id)
+    if not rows:
+        return rows, None, None
+    if forward:
+        next_cursor = cursor_of(rows[-1]) if has_more else None
+        prev_cursor = cursor_of(rows[0]) if after else None
+    else:
+        next_cursor = cursor_of(rows[-1])
+        prev_cursor = cursor_of(rows[0]) if has_more else None
+    return rows, next_cursor, prev_cursor